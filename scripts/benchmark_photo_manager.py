@@ -0,0 +1,398 @@
+#!/usr/bin/env -S uv run --script
+# /// script
+# requires-python = ">=3.9"
+# dependencies = [
+#     "pillow>=10.0.0",
+#     "piexif>=1.1.3",
+#     "numpy>=1.24.0",
+# ]
+# ///
+"""
+Benchmarks for the hot paths in photo_manager.py.
+Usage: uv run scripts/benchmark_photo_manager.py thumbnails [images...]
+       uv run scripts/benchmark_photo_manager.py gallery [--photos 10000] [--split pages]
+       uv run scripts/benchmark_photo_manager.py exif [images...]
+       uv run scripts/benchmark_photo_manager.py categories
+       uv run scripts/benchmark_photo_manager.py duplicates [--photos 100000]
+
+thumbnails and exif run against the photos in content/images/photography
+unless images are given; gallery renders a synthetic library in a temp directory;
+categories checks categorize_from_ai against the original substring scan on
+the gallery metadata and on random text; duplicates checks HashIndex lookups
+against a linear scan over random dHashes. None of them touch the real
+thumbnails, metadata or gallery page.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from gallery_store import open_store
+from photo_manager import (
+    CASCADE_MIN_PSNR, CATEGORY_PATTERNS, EXIF_TAGS, NEAR_DUPLICATE_DISTANCE, HashIndex, SmartPhotoManager, hamming,
+)
+
+
+def find_images(paths, limit):
+    if paths:
+        return [Path(path) for path in paths]
+    source_dir = Path("content/images/photography")
+    images = sorted(
+        path for path in source_dir.iterdir()
+        if path.suffix.lower() in ('.jpg', '.jpeg', '.png')
+    )
+    return images[:limit]
+
+
+def benchmark_thumbnails(args):
+    """Time direct vs cascaded thumbnails (and JPEG draft decoding) per image."""
+    images = find_images(args.images, args.limit)
+    if not images:
+        print("❌ No images to benchmark")
+        return 1
+
+    failed = False
+    totals = {'direct': 0.0, 'cascade': 0.0, 'cascade+draft': 0.0}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'image':40} {'direct':>8} {'cascade':>8} {'+draft':>8}  min PSNR")
+        print("-" * 80)
+
+        for img_path in images:
+            timings = {}
+            outputs = {}
+            for label, mode, draft in [
+                ('direct', 'direct', False),
+                ('cascade', 'cascade', False),
+                ('cascade+draft', 'cascade', True),
+            ]:
+                manager = SmartPhotoManager(thumbnail_mode=mode, jpeg_draft=draft)
+                manager.thumb_dir = Path(tmp) / label.replace('+', '_')
+                manager.thumb_dir.mkdir(exist_ok=True)
+
+                best = float('inf')
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    _, img, original_size = manager.open_image(img_path)
+                    manager.generate_thumbnails(img_path, img, original_size)
+                    best = min(best, time.perf_counter() - started)
+                timings[label] = best
+                totals[label] += best
+                outputs[label] = manager.thumb_dir
+
+            # Compare every cascaded size against the direct output
+            checker = SmartPhotoManager()
+            min_psnr = float('inf')
+            for label in ('cascade', 'cascade+draft'):
+                for size_name in checker.sizes:
+                    name = f"{img_path.stem}_{size_name}.jpg"
+                    with Image.open(outputs['direct'] / name) as direct, \
+                            Image.open(outputs[label] / name) as cascaded:
+                        min_psnr = min(min_psnr, checker.psnr(direct.convert('RGB'), cascaded.convert('RGB')))
+
+            status = "✅" if min_psnr >= CASCADE_MIN_PSNR else "❌"
+            failed = failed or min_psnr < CASCADE_MIN_PSNR
+            print(f"{img_path.name[:40]:40} {timings['direct']:7.2f}s {timings['cascade']:7.2f}s "
+                  f"{timings['cascade+draft']:7.2f}s  {min_psnr:5.1f} dB {status}")
+
+    print("-" * 80)
+    print(f"{'total':40} {totals['direct']:7.2f}s {totals['cascade']:7.2f}s {totals['cascade+draft']:7.2f}s")
+    print(f"\n🚀 cascade: {totals['direct'] / totals['cascade']:.2f}x, "
+          f"cascade+draft: {totals['direct'] / totals['cascade+draft']:.2f}x faster than direct")
+    print(f"📏 Quality threshold: {CASCADE_MIN_PSNR:.0f} dB PSNR against direct output")
+    return 1 if failed else 0
+
+
+def benchmark_exif(args):
+    """Time the header-only EXIF reader against Pillow's full EXIF parse."""
+    images = find_images(args.images, args.limit)
+    if not images:
+        print("❌ No images to benchmark")
+        return 1
+
+    manager = SmartPhotoManager(load_metadata=False)
+
+    def pillow(img_path):
+        with Image.open(img_path) as img:
+            exif = img._getexif() or {}
+            return [exif[tag_id] for _, tag_id, _ in EXIF_TAGS if tag_id in exif]
+
+    timings = {}
+    for label, read in [('pillow', pillow), ('header-only', manager.extract_exif_data)]:
+        best = float('inf')
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            for img_path in images:
+                read(img_path)
+            best = min(best, time.perf_counter() - started)
+        timings[label] = best
+
+    print(f"{'EXIF for ' + str(len(images)) + ' images':40} {'time':>8} {'per image':>10}")
+    print("-" * 60)
+    for label, elapsed in timings.items():
+        print(f"{label:40} {elapsed:7.3f}s {elapsed / len(images) * 1000:8.2f}ms")
+    print(f"\n🚀 header-only: {timings['pillow'] / timings['header-only']:.2f}x faster than Pillow")
+    return 0
+
+
+def reference_category(ai_analysis, exif_data):
+    """categorize_from_ai as it was originally: a substring scan per category keyword."""
+    caption = ai_analysis.get('caption', '').lower()
+    keywords_str = ' '.join(ai_analysis.get('keywords', [])).lower()
+    elements = ai_analysis.get('elements', '').lower()
+    all_text = f"{caption} {keywords_str} {elements}"
+
+    category_scores = {}
+    for category, patterns in CATEGORY_PATTERNS.items():
+        score = 0
+        for pattern in patterns:
+            if pattern in all_text:
+                score += 2
+            if pattern in keywords_str:
+                score += 1
+        if score > 0:
+            category_scores[category] = score
+    if category_scores:
+        return max(category_scores.items(), key=lambda x: x[1])[0]
+
+    if exif_data.get('settings', {}).get('focal_length_num', 0) > 200:
+        return 'telephoto'
+    hour = exif_data.get('hour', 12)
+    if hour < 6 or hour > 20:
+        return 'night'
+    return 'general'
+
+
+def random_analysis(rng):
+    """An ai_analysis made of keyword fragments run together, so keywords overlap."""
+    pieces = [keyword for keywords in CATEGORY_PATTERNS.values() for keyword in keywords]
+    pieces += ['a', 'the', ' ', 'wo', 'ing', 's', '-', 'up']
+
+    def text(count):
+        return ''.join(rng.choice(pieces)[:rng.randint(1, 12)] for _ in range(count))
+
+    return {
+        'caption': text(rng.randint(0, 40)),
+        'keywords': [text(rng.randint(1, 3)) for _ in range(rng.randint(0, 8))],
+        'elements': text(rng.randint(0, 20)),
+    }
+
+
+def benchmark_categories(args):
+    """Check categorize_from_ai against reference_category and time both."""
+    manager = SmartPhotoManager(load_metadata=False)
+    rng = random.Random(0)
+
+    metadata = open_store().load()
+    datasets = {
+        'gallery metadata': [(entry.get('ai_analysis', {}), entry.get('exif', {})) for entry in metadata.values()],
+        'random text': [(random_analysis(rng), {}) for _ in range(args.random)],
+    }
+    cases = [case for dataset in datasets.values() for case in dataset]
+
+    mismatches = 0
+    for ai_analysis, exif_data in cases:
+        expected = reference_category(ai_analysis, exif_data)
+        actual = manager.categorize_from_ai(ai_analysis, exif_data)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"❌ {actual!r} != {expected!r} for {ai_analysis!r:.120}")
+
+    print(f"{'categorize':40} {'time':>8} {'per photo':>10}")
+    print("-" * 60)
+    slower = []
+    for dataset, dataset_cases in datasets.items():
+        if not dataset_cases:
+            continue
+        timings = {}
+        for label, categorize in [('substring scan', reference_category),
+                                  ('keyword table', manager.categorize_from_ai)]:
+            best = float('inf')
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                for ai_analysis, exif_data in dataset_cases:
+                    categorize(ai_analysis, exif_data)
+                best = min(best, time.perf_counter() - started)
+            timings[label] = best
+            print(f"{dataset + ', ' + label:40} {best:7.3f}s {best / len(dataset_cases) * 1e6:8.1f}µs")
+        if timings['keyword table'] >= timings['substring scan']:
+            slower.append(dataset)
+
+    status = "✅" if not mismatches else "❌"
+    print(f"\n{status} {len(cases) - mismatches}/{len(cases)} categories match the substring scan "
+          f"({len(metadata)} from gallery metadata, {args.random} random)")
+    status = "✅" if not slower else "❌"
+    print(f"{status} keyword table is faster than the substring scan"
+          + (f" except on {', '.join(slower)}" if slower else ""))
+    return 1 if mismatches or slower else 0
+
+
+def benchmark_duplicates(args):
+    """Check HashIndex radius searches against a linear scan and time both."""
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(args.photos)]
+    # Plant a near-duplicate of every query, a few bits away
+    queries = []
+    for _ in range(args.queries):
+        query = rng.choice(hashes)
+        for bit in rng.sample(range(64), rng.randint(0, NEAR_DUPLICATE_DISTANCE)):
+            query ^= 1 << bit
+        queries.append(query)
+
+    started = time.perf_counter()
+    hash_index = HashIndex()
+    for index, value in enumerate(hashes):
+        hash_index.add(value, index)
+    built = time.perf_counter() - started
+
+    def linear(query):
+        found = []
+        for index, value in enumerate(hashes):
+            distance = hamming(query, value)
+            if distance <= NEAR_DUPLICATE_DISTANCE:
+                found.append((distance, index))
+        return sorted(found)
+
+    timings = {}
+    results = {}
+    for label, search in [('linear scan', linear),
+                          ('HashIndex', hash_index.search)]:
+        started = time.perf_counter()
+        results[label] = [search(query) for query in queries]
+        timings[label] = time.perf_counter() - started
+
+    print(f"HashIndex of {args.photos} dHashes built in {built:.2f}s")
+    print(f"{'lookup':20} {'time':>8} {'per query':>10}")
+    print("-" * 40)
+    for label, elapsed in timings.items():
+        print(f"{label:20} {elapsed:7.3f}s {elapsed / len(queries) * 1e3:8.2f}ms")
+
+    mismatches = sum(a != b for a, b in zip(results['linear scan'], results['HashIndex']))
+    status = "✅" if not mismatches else "❌"
+    print(f"\n{status} {len(queries) - mismatches}/{len(queries)} lookups match the linear scan "
+          f"(distance ≤ {NEAR_DUPLICATE_DISTANCE})")
+    return 1 if mismatches else 0
+
+
+GALLERY_PAGE = """Title: Photography
+
+<div class="photo-filters">
+</div>
+
+<div class="photo-masonry" id="photoGallery">
+</div>
+
+<!-- Lightbox Modal -->
+"""
+
+CATEGORIES = ['astronomy', 'portrait', 'nature', 'urban', 'architecture', 'wildlife', 'food',
+              'sunset', 'night', 'street', 'macro', 'beach', 'sports', 'telephoto', 'general']
+
+
+def synthetic_metadata(count, seed=0):
+    """Gallery metadata shaped like the real thing, for count photos."""
+    rng = random.Random(seed)
+    metadata = {}
+    for index in range(count):
+        filename = f"photo-{index:05d}.jpg"
+        description = f"Synthetic photo {index} " + "with a long AI description " * 12
+        metadata[filename] = {
+            'filename': filename,
+            'title': f"Synthetic Photo {index}",
+            'description': description,
+            'category': rng.choice(CATEGORIES),
+            'exif': {
+                'datetime': f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00",
+                'gps': {'coordinates': "1.0, 2.0", 'location': "1.0000, 2.0000"} if index % 3 == 0 else {},
+            },
+            'ai_analysis': {'descriptions': [description, description[:80]], 'caption': description},
+        }
+    return metadata
+
+
+def benchmark_gallery(args):
+    """Time update_gallery_page cold, warm and after a one-photo change."""
+    repo_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            Path("content/pages").mkdir(parents=True)
+            Path("content/pages/photography.md").write_text(GALLERY_PAGE)
+
+            manager = SmartPhotoManager(load_metadata=False, gallery_split=args.split)
+            manager.source_dir.mkdir(parents=True)
+            manager.metadata = synthetic_metadata(args.photos)
+
+            def timed(label):
+                started = time.perf_counter()
+                manager.update_gallery_page()
+                elapsed = time.perf_counter() - started
+                timings.append((label, elapsed))
+
+            timings = []
+            timed('cold (no render cache)')
+            timed('warm (nothing changed)')
+            first = next(iter(manager.metadata))
+            manager.metadata[first]['title'] = "Changed Title"
+            timed('one photo changed')
+            manager.render_cache_file.unlink()
+            timed('cold again')
+        finally:
+            os.chdir(repo_dir)
+
+    print(f"\n{'gallery render (' + args.split + '), ' + str(args.photos) + ' photos':40} {'time':>8}")
+    print("-" * 50)
+    for label, elapsed in timings:
+        print(f"{label:40} {elapsed:7.3f}s")
+
+    slowest = max(elapsed for _, elapsed in timings)
+    status = "✅" if slowest <= args.budget else "❌"
+    print(f"\n{status} Slowest render {slowest:.3f}s (budget {args.budget:.1f}s)")
+    return 0 if slowest <= args.budget else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark photo_manager.py hot paths.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    thumbnails = subparsers.add_parser('thumbnails', help="direct vs cascaded thumbnail generation")
+    thumbnails.add_argument('images', nargs='*', help="images to benchmark (default: the gallery originals)")
+    thumbnails.add_argument('--limit', type=int, default=5, help="how many gallery originals to use (default: 5)")
+    thumbnails.add_argument('--repeat', type=int, default=1, help="best of this many runs per image (default: 1)")
+    thumbnails.set_defaults(func=benchmark_thumbnails)
+
+    gallery = subparsers.add_parser('gallery', help="gallery page rendering on a synthetic library")
+    gallery.add_argument('--photos', type=int, default=10000, help="synthetic photos to render (default: 10000)")
+    gallery.add_argument('--budget', type=float, default=2.0,
+                         help="fail if any render takes longer than this many seconds (default: 2.0)")
+    gallery.add_argument('--split', choices=['single', 'pages', 'category'], default='single',
+                         help="--gallery-split mode to render with (default: single)")
+    gallery.set_defaults(func=benchmark_gallery)
+
+    exif = subparsers.add_parser('exif', help="header-only EXIF reading vs Pillow")
+    exif.add_argument('images', nargs='*', help="images to benchmark (default: the gallery originals)")
+    exif.add_argument('--limit', type=int, default=1000, help="how many gallery originals to use (default: 1000)")
+    exif.add_argument('--repeat', type=int, default=5, help="best of this many runs (default: 5)")
+    exif.set_defaults(func=benchmark_exif)
+
+    categories = subparsers.add_parser('categories', help="categorize_from_ai against the original substring scan")
+    categories.add_argument('--random', type=int, default=20000,
+                            help="random analyses to check besides the gallery metadata (default: 20000)")
+    categories.add_argument('--repeat', type=int, default=3, help="best of this many runs (default: 3)")
+    categories.set_defaults(func=benchmark_categories)
+
+    duplicates = subparsers.add_parser('duplicates', help="HashIndex near-duplicate lookups vs a linear scan")
+    duplicates.add_argument('--photos', type=int, default=100000, help="random dHashes to index (default: 100000)")
+    duplicates.add_argument('--queries', type=int, default=200, help="lookups to check and time (default: 200)")
+    duplicates.set_defaults(func=benchmark_duplicates)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
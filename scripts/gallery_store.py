@@ -0,0 +1,162 @@
+"""
+Storage backends for the photography gallery metadata.
+
+Both keep content/images/photography/gallery_metadata.json up to date for the
+site; they differ in what a single photo update costs:
+
+- JsonStore keeps everything in gallery_metadata.json. Updates are appended
+  to a journal and the whole file is rewritten at checkpoints.
+- ShardedStore keeps one small JSON file per photo under metadata/, so an
+  update rewrites only that photo's file (and git diffs stay per photo).
+  gallery_metadata.json is exported from the shards whenever they change.
+
+Used by photo_manager.py and set_photo_order.py.
+"""
+
+import json
+import os
+from pathlib import Path
+
+SOURCE_DIR = Path("content/images/photography")
+
+
+def write_atomic(path, text):
+    """Write text to path via a temp file and rename, so readers never see half a file."""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def dump_metadata(metadata):
+    return json.dumps(metadata, indent=2)
+
+
+class JsonStore:
+    """All metadata in gallery_metadata.json, with a journal between checkpoints."""
+
+    kind = 'json'
+    journaled = True
+
+    def __init__(self, source_dir=SOURCE_DIR):
+        self.metadata_file = source_dir / "gallery_metadata.json"
+        self.journal_file = source_dir / "gallery_metadata.journal"
+        self.resumed = 0
+
+    def load(self):
+        metadata = {}
+        if self.metadata_file.exists():
+            with open(self.metadata_file, 'r') as f:
+                metadata = json.load(f)
+
+        # Apply entries recorded by an interrupted run on top of the metadata
+        if self.journal_file.exists():
+            with open(self.journal_file, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut short by the crash
+                        continue
+                    metadata[record['filename']] = record['entry']
+                    self.resumed += 1
+
+        return metadata
+
+    def put(self, filename, entry):
+        """Append one entry to the journal, without rewriting the JSON."""
+        with open(self.journal_file, 'a') as f:
+            f.write(json.dumps({'filename': filename, 'entry': entry}) + '\n')
+
+    def save(self, metadata):
+        """Atomically rewrite gallery_metadata.json and clear the journal."""
+        write_atomic(self.metadata_file, dump_metadata(metadata))
+        if self.journal_file.exists():
+            self.journal_file.unlink()
+
+
+class ShardedStore:
+    """One JSON file per photo, exported to gallery_metadata.json on change."""
+
+    kind = 'sharded'
+    journaled = False
+
+    def __init__(self, source_dir=SOURCE_DIR):
+        self.metadata_file = source_dir / "gallery_metadata.json"
+        self.shard_dir = source_dir / "metadata"
+        self.resumed = 0
+        # Serialized form of each shard as last read or written
+        self.written = {}
+        self.changed = False
+        # Journal of the JsonStore being migrated from, deleted once the shards are written
+        self.migrated_journal = None
+
+    def shard_path(self, filename):
+        return self.shard_dir / f"{filename}.json"
+
+    def load(self):
+        if not self.shard_dir.exists():
+            # First use: start from the monolithic file (and any journal of an
+            # interrupted run); save() writes the shards
+            self.changed = True
+            legacy = JsonStore(self.metadata_file.parent)
+            metadata = legacy.load()
+            self.resumed = legacy.resumed
+            if legacy.journal_file.exists():
+                self.migrated_journal = legacy.journal_file
+            return metadata
+
+        metadata = {}
+        for shard in sorted(self.shard_dir.glob('*.json')):
+            text = shard.read_text()
+            entry = json.loads(text)
+            filename = entry.get('filename', shard.name[:-len('.json')])
+            metadata[filename] = entry
+            self.written[filename] = text
+        return metadata
+
+    def put(self, filename, entry):
+        """Write one photo's shard; nothing else is touched."""
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        text = dump_metadata(entry)
+        if self.written.get(filename) != text:
+            write_atomic(self.shard_path(filename), text)
+            self.written[filename] = text
+            self.changed = True
+
+    def save(self, metadata):
+        """Write changed shards, drop removed ones and re-export gallery_metadata.json."""
+        for filename, entry in metadata.items():
+            self.put(filename, entry)
+
+        for filename in set(self.written) - set(metadata):
+            self.shard_path(filename).unlink(missing_ok=True)
+            del self.written[filename]
+            self.changed = True
+
+        if self.changed or not self.metadata_file.exists():
+            self.export(metadata)
+            self.changed = False
+
+        # Its entries are in the shards now; left behind, a later --store json
+        # run would replay them over newer data
+        if self.migrated_journal is not None:
+            self.migrated_journal.unlink(missing_ok=True)
+            self.migrated_journal = None
+
+    def export(self, metadata, path=None):
+        """Write the monolithic gallery_metadata.json that the site consumes."""
+        ordered = {filename: metadata[filename] for filename in sorted(metadata)}
+        write_atomic(path or self.metadata_file, dump_metadata(ordered))
+
+
+STORES = {store.kind: store for store in (JsonStore, ShardedStore)}
+
+
+def open_store(kind=None, source_dir=SOURCE_DIR):
+    """Open the requested store, or whichever one the gallery already uses."""
+    if kind is None:
+        kind = 'sharded' if (source_dir / "metadata").is_dir() else 'json'
+    return STORES[kind](source_dir)
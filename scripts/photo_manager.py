@@ -4,6 +4,7 @@
 # dependencies = [
 #     "pillow>=10.0.0",
 #     "piexif>=1.1.3",
+#     "numpy>=1.24.0",
 #     "transformers>=4.36.0",
 #     "torch>=2.0.0",
 #     "einops>=0.8.0",
@@ -18,25 +19,501 @@ Works with any filename - uses AI to understand content.
 import os
 import json
 import hashlib
+import argparse
+import io
+import itertools
+import math
+import re
+import queue
+import sqlite3
+import string
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
+from html import escape
+from urllib.parse import quote
+import numpy as np
+from PIL import Image, ImageChops, ImageOps, ImageStat, features
+from PIL.ExifTags import GPSTAGS
 from datetime import datetime
 import piexif
 
-# For image understanding with Moondream2
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
-import os
+from gallery_store import STORES, open_store, write_atomic
+
+# torch/transformers are imported lazily in load_model() so that no-op
+# incremental runs never pay for them.
 
 # Enable MPS fallback for ops not implemented on Apple Silicon
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 
+# Model weights, pinned so cached answers stay valid. batch_generate()
+# mirrors this revision's batch_answer() through input_embeds() and
+# text_model; later revisions dropped both
+MODEL_ID = "vikhyatk/moondream2"
+MODEL_REVISION = "2024-08-26"
+
+# Questions asked of Moondream2 for every photo: (field, prompt, max_new_tokens)
+ANALYSIS_PROMPTS = [
+    ('caption', "Describe this photograph in detail.", 300),
+    ('title', "Create a creative, artistic title for this photo (2-4 words only):", 50),
+    ('poetic', "Describe this photo in a poetic, evocative way:", 300),
+    ('elements', "What are the main subjects or elements in this photo?", 256),
+    ('mood', "What is the mood or atmosphere of this photo?", 256),
+]
+
+# Single question that asks for all of the above at once (--analysis-mode structured)
+STRUCTURED_PROMPT = (
+    "Describe this photo as a JSON object with these keys: "
+    '"caption" (a detailed description of the photograph), '
+    '"title" (a creative, artistic title, 2-4 words only), '
+    '"poetic" (a poetic, evocative description), '
+    '"elements" (the main subjects or elements) and '
+    '"mood" (the mood or atmosphere).'
+)
+STRUCTURED_MAX_TOKENS = 900
+
+# Originals are hashed in chunks of this size rather than read into memory whole
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Algorithms accepted by --hash; xxh64 needs the optional xxhash package
+HASH_ALGORITHMS = ['md5', 'blake2b', 'xxh64']
+
+# Photos are downscaled to fit this box before analysis; Moondream2 works at a
+# far lower resolution, and it keeps analysis input small enough to hand back
+# from --jobs worker processes
+ANALYSIS_MAX_SIZE = 1600
+
+# Lowest PSNR (dB) a cascaded thumbnail may have against one resampled
+# straight from the original before --cascade-check falls back to direct
+CASCADE_MIN_PSNR = 40.0
+
+# Formats --format can add next to the JPEG thumbnails, with the quality each
+# is saved at unless --target-ssim / --target-bytes search for one
+FORMAT_QUALITY = {'webp': 90, 'avif': 70}
+FORMAT_OPTIONS = {'webp': {'method': 6}, 'avif': {'speed': 6}}
+
+# Qualities the search may pick from, and the block size SSIM is measured over
+QUALITY_SEARCH_RANGE = (30, 95)
+SSIM_BLOCK = 8
+
+# Widths --srcset-widths resizes every photo to by default, the JPEG quality of
+# those renditions, and the card's sizes attribute, which follows the
+# gallery's 1/2/3 column masonry breakpoints
+SRCSET_WIDTHS = [320, 480, 640, 960, 1280, 1600, 2000, 2400]
+SRCSET_QUALITY = 90
+SRCSET_SIZES = "(min-width: 1024px) 33vw, (min-width: 640px) 50vw, 100vw"
+
+# Placeholders are computed from the smallest thumbnail shrunk to fit this
+# box; BlurHash uses 4x3 components (3x4 for portrait photos)
+PLACEHOLDER_SIZE = 32
+BLURHASH_COMPONENTS = (4, 3)
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+# Near-duplicates (bursts, re-exports, light crops) are found with a 64-bit
+# dHash of the smallest thumbnail: photos whose hashes differ in at most
+# NEAR_DUPLICATE_DISTANCE bits count as near-duplicates
+DHASH_SIZE = 8
+NEAR_DUPLICATE_DISTANCE = 10
+
+# The EXIF tags extract_exif_data() uses, as (IFD, tag ID, name) in the order
+# Pillow's merged EXIF dict yields them (IFD0, then the Exif IFD, then GPS),
+# so DateTime still wins over DateTimeOriginal. Only these are looked up.
+EXIF_TAGS = [
+    ('0th', piexif.ImageIFD.Make, 'Make'),
+    ('0th', piexif.ImageIFD.Model, 'Model'),
+    ('0th', piexif.ImageIFD.DateTime, 'DateTime'),
+    ('Exif', piexif.ExifIFD.ExposureTime, 'ExposureTime'),
+    ('Exif', piexif.ExifIFD.FNumber, 'FNumber'),
+    ('Exif', piexif.ExifIFD.ISOSpeedRatings, 'ISOSpeedRatings'),
+    ('Exif', piexif.ExifIFD.DateTimeOriginal, 'DateTimeOriginal'),
+    ('Exif', piexif.ExifIFD.DateTimeDigitized, 'DateTimeDigitized'),
+    ('Exif', piexif.ExifIFD.FocalLength, 'FocalLength'),
+    ('Exif', piexif.ExifIFD.LensModel, 'LensModel'),
+    ('GPS', piexif.ImageIFD.GPSTag, 'GPSInfo'),
+]
+
+# Fields --refresh can recompute from what is already on disk (metadata, the
+# originals' EXIF headers, thumbnails), mapped to the fields derived from
+# them; refreshing a stage refreshes everything downstream of it too.
+# Stages run in the order listed here, each before the ones derived from it;
+# prototypes (which reads local embeddings) runs only when asked for, but
+# always after category
+REFRESH_GRAPH = {
+    'exif': ['category'],
+    'category': [],
+    'prototypes': [],
+    'title': [],
+    'description': [],
+    'keywords': [],
+    'placeholders': [],
+    'dhash': [],
+}
+
+# Category mapping based on AI understanding: every keyword found in the
+# caption, keywords or elements scores 2, plus 1 more if it is in the keywords
+CATEGORY_PATTERNS = {
+    'astronomy': ['moon', 'star', 'galaxy', 'eclipse', 'night sky', 'constellation', 'milky way', 'lunar', 'celestial'],
+    'portrait': ['person', 'people', 'man', 'woman', 'face', 'portrait', 'selfie', 'human'],
+    'nature': ['tree', 'forest', 'mountain', 'lake', 'river', 'landscape', 'nature', 'outdoor', 'hiking'],
+    'urban': ['city', 'building', 'street', 'skyline', 'urban', 'downtown', 'traffic', 'cityscape'],
+    'architecture': ['building', 'architecture', 'structure', 'bridge', 'interior', 'design', 'cathedral', 'clock tower'],
+    'wildlife': ['animal', 'bird', 'wildlife', 'zoo', 'pet', 'dog', 'cat'],
+    'food': ['food', 'meal', 'dish', 'restaurant', 'cooking', 'cuisine', 'cafe'],
+    'sunset': ['sunset', 'sunrise', 'golden hour', 'dusk', 'dawn'],
+    'night': ['night', 'dark', 'evening', 'lights', 'nocturnal'],
+    'street': ['street', 'road', 'sidewalk', 'people walking', 'pedestrian'],
+    'macro': ['close-up', 'macro', 'detail', 'texture'],
+    'beach': ['beach', 'ocean', 'sea', 'sand', 'coast', 'waves', 'waterfront'],
+    'sports': ['sport', 'game', 'playing', 'running', 'athlete']
+}
+
+
+def category_keywords(patterns):
+    """Each distinct keyword in patterns once, with the indices of the categories listing it."""
+    categories = list(patterns)
+    keywords = defaultdict(list)
+    for index, category in enumerate(categories):
+        for keyword in patterns[category]:
+            keywords[keyword].append(index)
+    return tuple((keyword, tuple(indices)) for keyword, indices in keywords.items())
+
+CATEGORY_NAMES = list(CATEGORY_PATTERNS)
+# Scored with one substring test per keyword, however many categories share it
+CATEGORY_KEYWORDS = category_keywords(CATEGORY_PATTERNS)
+
+# string.Template files the gallery cards are rendered from
+TEMPLATE_DIR = Path(__file__).resolve().parent / "templates"
+
+class PageTemplate:
+    """A string.Template file, split once into literal text and placeholders.
+    
+    Rendering is then a single join, with no regex work per card. Compiled
+    templates are shared by path, and digest (part of every card
+    fingerprint) changes whenever the file does.
+    """
+    
+    compiled = {}
+    
+    @classmethod
+    def load(cls, name):
+        path = TEMPLATE_DIR / name
+        if path not in cls.compiled:
+            cls.compiled[path] = cls(path.read_text())
+        return cls.compiled[path]
+    
+    def __init__(self, text):
+        # Template files end with a newline that isn't part of the markup
+        if text.endswith('\n'):
+            text = text[:-1]
+        self.digest = hashlib.md5(text.encode('utf-8')).hexdigest()
+        
+        self.literals = []
+        self.names = []
+        position = 0
+        literal = ''
+        for match in string.Template.pattern.finditer(text):
+            literal += text[position:match.start()]
+            position = match.end()
+            if match.group('escaped') is not None:
+                literal += '$'
+                continue
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError(f"Invalid placeholder in template: {match.group(0)!r}")
+            self.literals.append(literal)
+            self.names.append(name)
+            literal = ''
+        self.tail = literal + text[position:]
+    
+    def render(self, values):
+        parts = []
+        for literal, name in zip(self.literals, self.names):
+            parts.append(literal)
+            parts.append(str(values[name]))
+        parts.append(self.tail)
+        return ''.join(parts)
+
+class AnalysisCache:
+    """On-disk store of every Moondream2 answer, keyed by pixels, model and prompt.
+    
+    Renaming a photo, editing its EXIF or losing gallery_metadata.json no
+    longer costs a re-analysis, and changing one prompt only re-asks that one.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+    
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, response TEXT NOT NULL)"
+            )
+        return self.conn
+    
+    def key(self, pixel_hash, prompt, max_tokens):
+        raw = json.dumps([pixel_hash, MODEL_ID, MODEL_REVISION, prompt, max_tokens])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        row = self.connect().execute("SELECT response FROM answers WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def put(self, key, response):
+        self.connect().execute(
+            "INSERT OR REPLACE INTO answers (key, response) VALUES (?, ?)", (key, response)
+        )
+
+class FileStats:
+    """Size, mtime and content hash of every original as last seen here.
+    
+    mtimes only mean something on the machine that read them, so they are
+    kept in file_stats.json (not in git) rather than gallery_metadata.json.
+    An original whose size and mtime still match, with the hash its entry
+    records, is known to be unchanged without hashing it.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.stats = {}
+        self.changed = False
+        if path.exists():
+            try:
+                with open(path, 'r') as f:
+                    self.stats = json.load(f)
+            except ValueError:
+                self.stats = {}
+    
+    def matches(self, img_path, stat, file_hash):
+        return file_hash is not None and self.stats.get(img_path.name) == [stat.st_size, stat.st_mtime_ns, file_hash]
+    
+    def record(self, img_path, file_hash, stat=None):
+        stat = stat or img_path.stat()
+        value = [stat.st_size, stat.st_mtime_ns, file_hash]
+        if self.stats.get(img_path.name) != value:
+            self.stats[img_path.name] = value
+            self.changed = True
+    
+    def save(self, keep):
+        """Write the stats of the photos in keep, if anything changed."""
+        for filename in set(self.stats) - set(keep):
+            del self.stats[filename]
+            self.changed = True
+        if self.changed:
+            write_atomic(self.path, json.dumps(self.stats, sort_keys=True))
+            self.changed = False
+
+class EmbeddingIndex:
+    """Pooled Moondream2 image embeddings, one float16 row per photo.
+    
+    The rows live in embeddings.npy, memory-mapped on load, with
+    embeddings.json naming the photo behind each row and the model that
+    made them. Vectors are L2-normalised, so a dot product is the cosine
+    similarity and a nearest-neighbour search is one matrix product.
+    """
+    
+    def __init__(self, source_dir):
+        self.matrix_file = source_dir / "embeddings.npy"
+        self.index_file = source_dir / "embeddings.json"
+        self.model = [MODEL_ID, MODEL_REVISION]
+        self.loaded = False
+        self.rows = {}
+        self.matrix = None
+        self.pending = {}
+    
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not (self.index_file.exists() and self.matrix_file.exists()):
+            return
+        with open(self.index_file, 'r') as f:
+            index = json.load(f)
+        # Embeddings from another model aren't comparable; they get replaced
+        if index.get('model') == self.model:
+            self.rows = {filename: row for row, filename in enumerate(index['filenames'])}
+            self.matrix = np.load(self.matrix_file, mmap_mode='r')
+    
+    def __contains__(self, filename):
+        self.load()
+        return filename in self.pending or filename in self.rows
+    
+    def put(self, filename, vector):
+        self.load()
+        vector = np.asarray(vector, dtype=np.float32)
+        self.pending[filename] = (vector / (np.linalg.norm(vector) or 1)).astype(np.float16)
+    
+    def rename(self, old, new):
+        self.load()
+        if old in self.pending:
+            self.pending[new] = self.pending.pop(old)
+        elif old in self.rows:
+            self.pending[new] = np.array(self.matrix[self.rows[old]])
+    
+    def vectors(self, filenames=None):
+        """(filenames, float32 matrix of their rows) for every photo with an embedding."""
+        self.load()
+        if filenames is None:
+            filenames = sorted(set(self.rows) | set(self.pending))
+        filenames = [filename for filename in filenames if filename in self]
+        rows = [
+            self.pending[filename] if filename in self.pending else self.matrix[self.rows[filename]]
+            for filename in filenames
+        ]
+        if not rows:
+            return [], np.zeros((0, 0), dtype=np.float32)
+        return filenames, np.stack(rows).astype(np.float32)
+    
+    def save(self, keep):
+        """Rewrite the index with the photos in keep, if anything changed."""
+        self.load()
+        filenames = sorted(filename for filename in keep if filename in self)
+        if not self.pending and filenames == sorted(self.rows):
+            return
+        
+        _, matrix = self.vectors(filenames)
+        tmp_path = self.matrix_file.with_name(self.matrix_file.name + '.tmp')
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=matrix.shape)
+        out[:] = matrix
+        out.flush()
+        del out
+        os.replace(tmp_path, self.matrix_file)
+        write_atomic(self.index_file, json.dumps({
+            'model': self.model, 'dim': matrix.shape[1], 'filenames': filenames,
+        }))
+        
+        self.rows = {filename: row for row, filename in enumerate(filenames)}
+        self.matrix = np.load(self.matrix_file, mmap_mode='r')
+        self.pending = {}
+    
+    def nearest(self, vector, count, exclude=None):
+        """The count most similar photos to vector, as [(filename, similarity)]."""
+        filenames, matrix = self.vectors()
+        if not filenames:
+            return []
+        similarities = matrix @ np.asarray(vector, dtype=np.float32)
+        if exclude in filenames:
+            similarities[filenames.index(exclude)] = -np.inf
+        count = min(count, len(filenames) - (exclude in filenames))
+        if count <= 0:
+            return []
+        top = np.argpartition(-similarities, count - 1)[:count]
+        top = top[np.argsort(-similarities[top])]
+        return [(filenames[row], float(similarities[row])) for row in top]
+
+def hamming(a, b):
+    """Number of differing bits between two integer hashes."""
+    return bin(a ^ b).count('1')
+
+class HashIndex:
+    """Multi-index hash table of 64-bit hashes, for Hamming-radius lookups.
+    
+    Each hash is split into chunks, each indexed in its own dict. Two
+    hashes within radius bits of each other must agree to within
+    radius // chunks bits on at least one chunk (pigeonhole), so a search
+    only probes those few neighbouring keys per chunk and checks the
+    photos filed under them, instead of comparing against every photo.
+    """
+    
+    def __init__(self, radius=NEAR_DUPLICATE_DISTANCE, chunks=4):
+        self.radius = radius
+        self.bits = 64 // chunks
+        self.tables = [defaultdict(list) for _ in range(chunks)]
+        # Every chunk-sized XOR mask of at most radius // chunks bits
+        self.masks = [
+            sum(1 << bit for bit in flipped)
+            for count in range(radius // chunks + 1)
+            for flipped in itertools.combinations(range(self.bits), count)
+        ]
+    
+    def chunks(self, value):
+        mask = (1 << self.bits) - 1
+        return [(value >> (self.bits * index)) & mask for index in range(len(self.tables))]
+    
+    def add(self, value, item):
+        for table, key in zip(self.tables, self.chunks(value)):
+            table[key].append((value, item))
+    
+    def search(self, value):
+        """[(distance, item)] for every item within radius of value, closest first."""
+        found = set()
+        for table, key in zip(self.tables, self.chunks(value)):
+            for mask in self.masks:
+                for other, item in table.get(key ^ mask, ()):
+                    distance = hamming(value, other)
+                    if distance <= self.radius:
+                        found.add((distance, item))
+        return sorted(found)
+
+# Lowest cosine similarity to a category prototype (the mean embedding of
+# the photos keyword matching put in that category) for the prototypes
+# refresh to move a 'general' photo into that category
+PROTOTYPE_MIN_SIMILARITY = 0.85
+
+# Slug of the main gallery page; --gallery-split shards are named after it
+GALLERY_SLUG = "photography"
+
+# Photos per page for --gallery-split
+GALLERY_PAGE_SIZE = 100
+
+# Compact manifest of the gallery for client-side fetching and filtering;
+# bump the version whenever its shape changes
+MANIFEST_VERSION = 1
+MANIFEST_COMPRESSION = ['gzip', 'brotli']
+
+# Defaults for how often gallery_metadata.json is checkpointed during a run
+CHECKPOINT_EVERY = 25
+CHECKPOINT_SECONDS = 300
+
+# Bounded queue length between --pipeline stages; caps how many decoded
+# originals can be held in memory at once
+PIPELINE_QUEUE_SIZE = 2
+
+# Marks the end of the stream on a --pipeline queue
+PIPELINE_DONE = object()
+
+# SmartPhotoManager used by each --jobs worker process, set up by init_worker()
+worker_manager = None
+
+def init_worker(settings, thumb_dir):
+    global worker_manager
+    worker_manager = SmartPhotoManager(load_metadata=False, **settings)
+    worker_manager.thumb_dir = Path(thumb_dir)
+
+def hash_in_worker(img_path, algorithm):
+    return worker_manager.file_hash(img_path, algorithm)
+
+def prepare_in_worker(img_path, previous=None, file_hash=None):
+    return worker_manager.prepare_image(img_path, previous, file_hash)
+
 class SmartPhotoManager:
-    def __init__(self):
+    def __init__(self, batch_size=1, analysis_mode='questions', hash_algorithm='md5',
+                 thumbnail_mode='direct', jpeg_draft=False, cascade_check=False, jobs=1,
+                 pipeline=False, checkpoint_every=CHECKPOINT_EVERY,
+                 checkpoint_seconds=CHECKPOINT_SECONDS, store=None, load_metadata=True,
+                 gallery_split='single', page_size=GALLERY_PAGE_SIZE, manifest_compress=(),
+                 formats=(), target_ssim=None, target_bytes=None, srcset_widths=None,
+                 prune=False, dry_run=False, refresh=None, embed=False,
+                 reuse_duplicates=False):
         self.source_dir = Path("content/images/photography")
         self.thumb_dir = self.source_dir / "thumbnails"
         self.metadata_file = self.source_dir / "gallery_metadata.json"
+        self.render_cache_file = self.source_dir / "gallery_render_cache.json"
+        self.gallery_page = Path("content/pages") / f"{GALLERY_SLUG}.md"
+        self.shard_dir = self.source_dir / "gallery_shards"
+        self.manifest_file = self.source_dir / "gallery_manifest.json"
+        # Pre-compressed copies of the manifest to write next to it
+        self.manifest_compress = list(manifest_compress or [])
+        
+        # 'single' puts every card on photography.md; 'pages' splits them into
+        # pages of page_size; 'category' adds pages per category
+        self.gallery_split = gallery_split
+        self.page_size = max(1, page_size)
+        self.templates_digest = None
         
         # Much larger thumbnail sizes for better visibility
         self.sizes = {
@@ -45,17 +522,149 @@ class SmartPhotoManager:
             'large': (2400, 2400, 96)
         }
         
-        # Load existing metadata
-        self.metadata = {}
-        if self.metadata_file.exists():
-            with open(self.metadata_file, 'r') as f:
-                self.metadata = json.load(f)
+        # 'direct' resamples every size from the original, 'cascade' derives
+        # each size from the next larger one
+        self.thumbnail_mode = thumbnail_mode
+        self.cascade_check = cascade_check
+        
+        # Let libjpeg decode JPEGs at a reduced scale that still covers the
+        # largest thumbnail
+        self.jpeg_draft = jpeg_draft
+        
+        # Width ladder for the cards' srcset; each rendition's file name is a
+        # key of the original's hash, its width and the encoder settings
+        self.srcset_widths = sorted(set(srcset_widths or []))
+        self.srcset_dir = self.thumb_dir / "srcset"
+        
+        # WebP/AVIF copies of every thumbnail, for formats this Pillow can write
+        self.formats = [fmt for fmt in formats if features.check(fmt)]
+        self.unsupported_formats = [fmt for fmt in formats if fmt not in self.formats]
+        
+        # Encoder quality search for those copies: ('ssim', minimum SSIM) or
+        # ('bytes', largest file size); the choice is recorded in metadata
+        self.target_ssim = target_ssim
+        self.target_bytes = target_bytes
+        self.quality_target = None
+        if target_ssim is not None:
+            self.quality_target = ('ssim', target_ssim)
+        elif target_bytes is not None:
+            self.quality_target = ('bytes', target_bytes)
+        
+        # Load existing metadata (see gallery_store.py). Every finished image
+        # is written to the store on its own; with the JSON store it goes to
+        # a journal and the full file is only rewritten (atomically) at
+        # checkpoints and at the end of a run. A journal left behind by an
+        # interrupted run is replayed on load, so its images aren't redone.
+        self.store = open_store(store, self.source_dir)
+        self.metadata = self.store.load() if load_metadata else {}
+        self.metadata_lock = threading.RLock()
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_seconds = checkpoint_seconds
+        self.unsaved = self.store.resumed
+        self.last_checkpoint = time.monotonic()
+        if self.store.resumed:
+            print(f"♻️  Resuming: recovered {self.store.resumed} image(s) from an interrupted run")
+        
+        # Moondream2 is loaded on demand by load_model() the first time an
+        # image actually needs analysis; runs where everything is up to date
+        # never import torch or touch the weights.
+        self.model = None
+        self.tokenizer = None
+        self.device = None
+        self.model_loaded = False
+        self.ai_available = True
+        
+        # Number of new photos analysed together in one batched pass
+        self.batch_size = max(1, batch_size)
+        
+        # 'questions' asks each ANALYSIS_PROMPTS question separately,
+        # 'structured' asks STRUCTURED_PROMPT once and parses the answer
+        self.analysis_mode = analysis_mode
+        
+        # Hash used for new or changed photos; existing entries are checked
+        # with whichever algorithm they were recorded with
+        self.hash_algorithm = hash_algorithm
+        self.known_hashes = {}
+        
+        # Local size/mtime record behind the skip-without-hashing fast path
+        self.file_stats = FileStats(self.source_dir / "file_stats.json")
         
-        # Initialize Moondream2 model for image understanding
-        print("🌙 Loading Moondream2 - Tiny but powerful vision model...")
+        # Worker processes for hashing, EXIF and thumbnails; inference always
+        # stays in this process
+        self.jobs = max(1, jobs)
+        
+        # Overlap hashing, decoding, inference and thumbnail encoding across
+        # images with threads joined by bounded queues
+        self.pipeline = pipeline
+        
+        # Every answer Moondream2 gives is kept here and reused on later runs
+        self.analysis_cache = AnalysisCache(self.source_dir / "analysis_cache.sqlite")
+        
+        # Image embeddings pooled from every encode_image() call; embed
+        # encodes the photos that don't have one yet (no generation)
+        self.embeddings = EmbeddingIndex(self.source_dir)
+        self.embed = embed
+        self.prototypes = None
+        
+        # HashIndex of every entry's dHash, built on the first near-duplicate
+        # lookup; reuse_duplicates copies a near-duplicate's analysis instead
+        # of running inference
+        self.duplicate_index = None
+        self.reuse_duplicates = reuse_duplicates
+        # dHash and analysis (None until analysed) of the photos checked
+        # this run but not recorded yet
+        self.pending_dhashes = {}
+        self.pending_analyses = {}
+        
+        # Remove metadata and thumbnails whose original is gone; dry_run only
+        # reports what reconcile() would rename and remove
+        self.prune = prune
+        self.dry_run = dry_run
+        
+        # Derived fields to recompute for the whole library instead of a
+        # normal run; no inference and no thumbnails
+        self.refresh = self.refresh_order(refresh or [])
+    
+    def store_entry(self, filename, checkpoint=True):
+        """Persist one finished entry, checkpointing the JSON store when due.
+        
+        Library-wide metadata passes (refresh, thumbnail and rendition
+        backfills) pass checkpoint=False: their entries are only journaled,
+        and gallery_metadata.json is rewritten once by the save_metadata()
+        at the end of the run rather than every CHECKPOINT_EVERY photos.
+        """
+        self.store.put(filename, self.metadata[filename])
+        if not self.store.journaled or not checkpoint:
+            return
+        
+        self.unsaved += 1
+        if (self.unsaved >= self.checkpoint_every
+                or time.monotonic() - self.last_checkpoint >= self.checkpoint_seconds):
+            print(f"  💾 Checkpointing metadata ({len(self.metadata)} photos)")
+            self.save_metadata()
+    
+    def save_metadata(self):
+        """Persist all metadata and bring gallery_metadata.json up to date."""
+        with self.metadata_lock:
+            self.store.save(self.metadata)
+            self.file_stats.save(self.metadata)
+            self.unsaved = 0
+            self.last_checkpoint = time.monotonic()
+    
+    def load_model(self):
+        """Load Moondream2 on first use. Returns True if the model is usable."""
+        if self.model_loaded:
+            return self.ai_available
+        self.model_loaded = True
+        
+        print("\n🌙 Loading Moondream2 - Tiny but powerful vision model...")
         print("   Only 1.86B parameters - optimized for your Mac!")
         
         try:
+            # For image understanding with Moondream2
+            from transformers import AutoTokenizer, AutoModelForCausalLM
+            import torch
+            
             # Detect device - prefer MPS (Apple Silicon) over CPU
             if torch.backends.mps.is_available():
                 self.device = "mps"
@@ -67,11 +676,10 @@ class SmartPhotoManager:
                 self.device = "cpu"
                 print("   💻 Using CPU (still fast with Moondream2!)")
             
-            # Load Moondream2 - a tiny but powerful vision-language model
-            model_id = "vikhyatk/moondream2"
-            
             # Load tokenizer (Moondream2 doesn't need a separate processor)
-            self.tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                MODEL_ID, revision=MODEL_REVISION, trust_remote_code=True
+            )
             
             # Load model with appropriate dtype for device
             if self.device in ["mps", "cuda"]:
@@ -80,7 +688,8 @@ class SmartPhotoManager:
                 torch_dtype = torch.float32
                 
             self.model = AutoModelForCausalLM.from_pretrained(
-                model_id,
+                MODEL_ID,
+                revision=MODEL_REVISION,
                 torch_dtype=torch_dtype,
                 trust_remote_code=True
             )
@@ -95,62 +704,245 @@ class SmartPhotoManager:
             print(f"   ⚠️  Could not load Moondream2: {e}")
             print("   Falling back to basic analysis")
             self.ai_available = False
+        
+        return self.ai_available
     
-    def understand_image(self, img_path):
+    def understand_image(self, img_path, img=None):
         """Use Moondream2 to understand what's in the image and generate creative titles."""
-        if not self.ai_available:
-            return self.basic_analysis(img_path)
+        return self.understand_images([img_path], None if img is None else [img])[0]
+    
+    def understand_images(self, img_paths, images=None):
+        """Analyse images together, running each uncached prompt as one padded batch.
         
+        images may hold the analysis images already made by prepare_image().
+        """
         try:
-            img = Image.open(img_path).convert('RGB')
-            
-            # Encode image once using Moondream2's method
-            enc_image = self.model.encode_image(img)
-            
-            # Helper function to ask questions about the image with longer responses
-            def ask_moondream(prompt, max_tokens=256):
-                return self.model.answer_question(enc_image, prompt, self.tokenizer, max_new_tokens=max_tokens)
-            
-            # Generate various descriptions with longer token limits for complete responses
-            caption = ask_moondream("Describe this photograph in detail.", max_tokens=300)
-            title = ask_moondream("Create a creative, artistic title for this photo (2-4 words only):", max_tokens=50)
-            poetic_desc = ask_moondream("Describe this photo in a poetic, evocative way:", max_tokens=300)
-            elements = ask_moondream("What are the main subjects or elements in this photo?")
-            mood = ask_moondream("What is the mood or atmosphere of this photo?")
-            
-            # Clean up title
-            title = title.strip('"\'.,!').strip()
-            if len(title.split()) > 5:
-                title = ' '.join(title.split()[:4])
-            
-            # Extract keywords from all text
-            all_text = f"{caption} {elements}".lower()
-            words = all_text.split()
-            skip_words = {'a', 'an', 'the', 'is', 'are', 'was', 'were', 'of', 'with', 'in', 'on', 'at', 'to', 'and', 'very', 'this', 'that', 'it', 'be', 'have', 'has'}
-            
-            keywords = []
-            for word in words:
-                word = word.strip('.,!?;:\'"-')
-                if len(word) > 3 and word not in skip_words and word not in keywords:
-                    keywords.append(word)
-                    if len(keywords) >= 8:
-                        break
-            
-            # Use poetic description if it's good, otherwise use detailed caption
-            final_caption = poetic_desc if len(poetic_desc) > 20 else caption
-            
-            return {
-                'caption': final_caption,
-                'title': title.title() if title else "Untitled",
-                'descriptions': [caption, poetic_desc, mood],
-                'keywords': keywords,
-                'elements': elements,
-                'ai_model': 'Moondream2'
-            }
+            started = time.perf_counter()
+            if images is None:
+                images = [None] * len(img_paths)
+            photos = [self.load_for_analysis(img_path, img) for img_path, img in zip(img_paths, images)]
+            analyses = [self.build_analysis(answers) for answers in self.analyse(photos)]
+            for img_path, photo in zip(img_paths, photos):
+                if photo.get('embedding') is not None:
+                    self.embeddings.put(img_path.name, photo['embedding'])
+            print(f"  ⏱️  Analysis took {time.perf_counter() - started:.1f}s "
+                  f"for {len(img_paths)} image(s) ({self.analysis_mode})")
+            return analyses
             
         except Exception as e:
-            print(f"  ⚠️  AI analysis failed: {e}")
-            return self.basic_analysis(img_path)
+            if len(img_paths) > 1:
+                print(f"  ⚠️  Batched AI analysis failed ({e}), analysing one at a time")
+                return [self.understand_image(img_path, img) for img_path, img in zip(img_paths, images)]
+            if self.ai_available:
+                print(f"  ⚠️  AI analysis failed: {e}")
+            return [self.basic_analysis(img_paths[0])]
+    
+    def load_for_analysis(self, img_path, img=None):
+        """Hash an image's decoded pixels; it is only encoded if the cache misses."""
+        if img is None:
+            _, img, original_size = self.open_image(img_path)
+            img = self.analysis_image(img_path, img, original_size)
+        return {'image': img, 'pixel_hash': self.pixel_hash(img), 'enc_image': None}
+    
+    def pixel_hash(self, img):
+        """Hash decoded pixels, so renames and metadata-only edits keep the same key."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode('ascii'))
+        digest.update(img.tobytes())
+        return digest.hexdigest()
+    
+    def analyse(self, photos):
+        """Run the configured analysis over photos, returning raw answers per photo."""
+        if self.analysis_mode != 'structured':
+            return self.ask_questions(photos)
+        
+        responses = self.ask(photos, STRUCTURED_PROMPT, STRUCTURED_MAX_TOKENS)
+        answers = [self.parse_structured_answer(response) for response in responses]
+        
+        # Photos whose answer didn't parse go through the per-question path
+        fallback = [index for index, image_answers in enumerate(answers) if image_answers is None]
+        if fallback:
+            print(f"  ⚠️  Could not parse structured answer for {len(fallback)} image(s), "
+                  "asking each question separately")
+            for index, image_answers in zip(fallback, self.ask_questions([photos[i] for i in fallback])):
+                answers[index] = image_answers
+        
+        return answers
+    
+    def ask_questions(self, photos):
+        """Ask each ANALYSIS_PROMPTS question about every photo."""
+        # Generate various descriptions with longer token limits for complete responses
+        answers = [{} for _ in photos]
+        for field, prompt, max_tokens in ANALYSIS_PROMPTS:
+            for image_answers, response in zip(answers, self.ask(photos, prompt, max_tokens)):
+                image_answers[field] = response
+        return answers
+    
+    def ask(self, photos, prompt, max_tokens):
+        """Answer one prompt for each photo, only running Moondream2 on cache misses."""
+        responses = [None] * len(photos)
+        misses = []
+        for index, photo in enumerate(photos):
+            key = self.analysis_cache.key(photo['pixel_hash'], prompt, max_tokens)
+            cached = self.analysis_cache.get(key)
+            if cached is None:
+                misses.append((index, key))
+            else:
+                responses[index] = cached
+        
+        if misses:
+            miss_photos = [photos[index] for index, _ in misses]
+            self.encode(miss_photos)
+            if len(miss_photos) == 1:
+                generated = [self.model.answer_question(
+                    miss_photos[0]['enc_image'], prompt, self.tokenizer, max_new_tokens=max_tokens
+                )]
+            else:
+                generated = self.batch_generate(
+                    [photo['enc_image'] for photo in miss_photos], prompt, max_tokens
+                )
+            
+            for (index, key), response in zip(misses, generated):
+                self.analysis_cache.put(key, response)
+                responses[index] = response
+        
+        return responses
+    
+    def encode(self, photos):
+        """Encode every photo that isn't encoded yet, in a single encode_image call."""
+        pending = [photo for photo in photos if photo['enc_image'] is None]
+        if not pending:
+            return
+        if not self.load_model():
+            raise RuntimeError("Moondream2 is not available")
+        
+        if len(pending) == 1:
+            pending[0]['enc_image'] = self.model.encode_image(pending[0]['image'])
+        else:
+            encoded = self.model.encode_image([photo['image'] for photo in pending])
+            for photo, enc_image in zip(pending, encoded):
+                photo['enc_image'] = enc_image.unsqueeze(0)
+        
+        # Keep a mean-pooled copy of the encoding for the embedding index
+        for photo in pending:
+            enc_image = photo['enc_image']
+            photo['embedding'] = enc_image.float().reshape(-1, enc_image.shape[-1]).mean(0).cpu().numpy()
+    
+    def parse_structured_answer(self, text):
+        """Parse the answer to STRUCTURED_PROMPT into per-question answers.
+        
+        Accepts a JSON object anywhere in the text, or failing that one
+        "key: value" line per field. Returns None if any field is missing.
+        """
+        fields = [field for field, _, _ in ANALYSIS_PROMPTS]
+        parsed = {}
+        
+        match = re.search(r'\{.*\}', text, re.DOTALL)
+        if match:
+            try:
+                data = json.loads(match.group(0))
+                if isinstance(data, dict):
+                    parsed = {str(key).lower(): value for key, value in data.items()}
+            except ValueError:
+                pass
+        
+        if not all(field in parsed for field in fields):
+            parsed = {}
+            for line in text.splitlines():
+                key, sep, value = line.partition(':')
+                key = key.strip().strip('"*-').strip().lower()
+                if sep and key in fields and value.strip():
+                    parsed[key] = value.strip().strip('",').strip()
+        
+        answers = {}
+        for field in fields:
+            value = parsed.get(field)
+            if isinstance(value, list):
+                value = ', '.join(str(item) for item in value)
+            if not isinstance(value, str) or not value.strip():
+                return None
+            answers[field] = value.strip()
+        
+        return answers
+    
+    def batch_generate(self, enc_images, prompt, max_tokens):
+        """Ask the same question about several encoded images in one generate() call.
+        
+        Mirrors Moondream2's own batch_answer(), but takes embeddings that were
+        already encoded so the vision encoder runs once per batch, not per prompt.
+        """
+        import torch
+        
+        templated = f"<image>\n\nQuestion: {prompt}\n\nAnswer:"
+        prompt_embs = [
+            self.model.input_embeds(templated, enc_image, self.tokenizer)[0]
+            for enc_image in enc_images
+        ]
+        
+        # Left-pad with BOS so every sequence ends where generation starts
+        bos_emb = prompt_embs[0][0]
+        max_len = max(emb.shape[0] for emb in prompt_embs)
+        inputs_embeds = torch.stack([
+            torch.cat([bos_emb.repeat(max_len - emb.shape[0], 1), emb])
+            for emb in prompt_embs
+        ])
+        attention_mask = torch.stack([
+            torch.cat([
+                torch.zeros(max_len - emb.shape[0], dtype=torch.long),
+                torch.ones(emb.shape[0], dtype=torch.long),
+            ])
+            for emb in prompt_embs
+        ]).to(inputs_embeds.device)
+        
+        with torch.no_grad():
+            output_ids = self.model.text_model.generate(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                eos_token_id=self.tokenizer.eos_token_id,
+                bos_token_id=self.tokenizer.bos_token_id,
+                pad_token_id=self.tokenizer.bos_token_id,
+                max_new_tokens=max_tokens,
+            )
+        
+        return [text.strip() for text in self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)]
+    
+    def build_analysis(self, answers):
+        """Turn raw Moondream2 answers into the ai_analysis dict stored in metadata."""
+        caption = answers['caption']
+        title = answers['title']
+        poetic_desc = answers['poetic']
+        elements = answers['elements']
+        mood = answers['mood']
+        
+        # Clean up title
+        title = title.strip('"\'.,!').strip()
+        if len(title.split()) > 5:
+            title = ' '.join(title.split()[:4])
+        
+        # Extract keywords from all text
+        all_text = f"{caption} {elements}".lower()
+        words = all_text.split()
+        skip_words = {'a', 'an', 'the', 'is', 'are', 'was', 'were', 'of', 'with', 'in', 'on', 'at', 'to', 'and', 'very', 'this', 'that', 'it', 'be', 'have', 'has'}
+        
+        keywords = []
+        for word in words:
+            word = word.strip('.,!?;:\'"-')
+            if len(word) > 3 and word not in skip_words and word not in keywords:
+                keywords.append(word)
+                if len(keywords) >= 8:
+                    break
+        
+        # Use poetic description if it's good, otherwise use detailed caption
+        final_caption = poetic_desc if len(poetic_desc) > 20 else caption
+        
+        return {
+            'caption': final_caption,
+            'title': title.title() if title else "Untitled",
+            'descriptions': [caption, poetic_desc, mood],
+            'keywords': keywords,
+            'elements': elements,
+            'ai_model': 'Moondream2'
+        }
     
     def basic_analysis(self, img_path):
         """Fallback basic analysis if AI is not available."""
@@ -161,47 +953,35 @@ class SmartPhotoManager:
             'ai_model': 'basic'
         }
     
-    def categorize_from_ai(self, ai_analysis, exif_data):
-        """Categorize based on AI understanding and EXIF."""
+    def categorize_from_ai(self, ai_analysis, exif_data, keywords_only=False):
+        """Categorize based on AI understanding and EXIF.
+        
+        With keywords_only, returns None instead of falling back to EXIF hints.
+        """
         caption = ai_analysis.get('caption', '').lower()
         keywords = ai_analysis.get('keywords', [])
         elements = ai_analysis.get('elements', '').lower()
         keywords_str = ' '.join(keywords).lower()
+        
         all_text = f"{caption} {keywords_str} {elements}"
         
-        # Category mapping based on AI understanding
-        category_patterns = {
-            'astronomy': ['moon', 'star', 'galaxy', 'eclipse', 'night sky', 'constellation', 'milky way', 'lunar', 'celestial'],
-            'portrait': ['person', 'people', 'man', 'woman', 'face', 'portrait', 'selfie', 'human'],
-            'nature': ['tree', 'forest', 'mountain', 'lake', 'river', 'landscape', 'nature', 'outdoor', 'hiking'],
-            'urban': ['city', 'building', 'street', 'skyline', 'urban', 'downtown', 'traffic', 'cityscape'],
-            'architecture': ['building', 'architecture', 'structure', 'bridge', 'interior', 'design', 'cathedral', 'clock tower'],
-            'wildlife': ['animal', 'bird', 'wildlife', 'zoo', 'pet', 'dog', 'cat'],
-            'food': ['food', 'meal', 'dish', 'restaurant', 'cooking', 'cuisine', 'cafe'],
-            'sunset': ['sunset', 'sunrise', 'golden hour', 'dusk', 'dawn'],
-            'night': ['night', 'dark', 'evening', 'lights', 'nocturnal'],
-            'street': ['street', 'road', 'sidewalk', 'people walking', 'pedestrian'],
-            'macro': ['close-up', 'macro', 'detail', 'texture'],
-            'beach': ['beach', 'ocean', 'sea', 'sand', 'coast', 'waves', 'waterfront'],
-            'sports': ['sport', 'game', 'playing', 'running', 'athlete']
-        }
+        # Score each category based on keyword matches
+        category_scores = None
+        for keyword, categories in CATEGORY_KEYWORDS:
+            if keyword in all_text:
+                if category_scores is None:
+                    category_scores = [0] * len(CATEGORY_NAMES)
+                # Direct text match, plus a bonus for a keyword match
+                points = 3 if keyword in keywords_str else 2
+                for index in categories:
+                    category_scores[index] += points
         
-        # Check each category
-        category_scores = {}
-        for category, patterns in category_patterns.items():
-            score = 0
-            for pattern in patterns:
-                if pattern in all_text:
-                    score += 2  # Direct text match
-                if pattern in keywords_str:
-                    score += 1  # Keyword match bonus
-            if score > 0:
-                category_scores[category] = score
-        
-        # Return the best matching category
+        # Return the best matching category (ties go to the one listed first)
         if category_scores:
-            best_category = max(category_scores.items(), key=lambda x: x[1])[0]
-            return best_category
+            return CATEGORY_NAMES[max(range(len(CATEGORY_NAMES)), key=category_scores.__getitem__)]
+        
+        if keywords_only:
+            return None
         
         # Check EXIF for additional hints
         focal = exif_data.get('settings', {}).get('focal_length_num', 0)
@@ -214,8 +994,90 @@ class SmartPhotoManager:
         
         return 'general'
     
-    def extract_exif_data(self, img_path):
-        """Extract comprehensive EXIF data including GPS."""
+    def open_image(self, img_path, draft=None):
+        """Read and decode an image once for every stage of process_image.
+        
+        Returns the EXIF data, an orientation-corrected RGB image that
+        analysis and thumbnailing both work from, and the upright size of the
+        original (which differs from the image's size when a JPEG is decoded
+        at a reduced scale). draft defaults to --jpeg-draft.
+        """
+        if draft is None:
+            draft = self.jpeg_draft
+        with Image.open(img_path) as img:
+            exif_data = self.extract_exif_data(img_path, img)
+            original_size = img.size
+            
+            if draft and img.format == 'JPEG':
+                draft_size = self.draft_size(img.size)
+                if draft_size:
+                    img.draft('RGB', draft_size)
+            decoded_size = img.size
+            
+            img = self.upright_rgb(img)
+            if img.size != decoded_size:
+                original_size = original_size[::-1]
+        
+        return exif_data, img, tuple(original_size)
+    
+    def upright_rgb(self, img):
+        """Decode img turned upright by its EXIF orientation, as RGB."""
+        # Handle EXIF orientation
+        try:
+            img = ImageOps.exif_transpose(img)
+        except:
+            pass
+        
+        # Convert to RGB if needed
+        if img.mode in ('RGBA', 'LA', 'P'):
+            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'RGBA':
+                rgb_img.paste(img, mask=img.split()[-1])
+            else:
+                rgb_img.paste(img)
+            img = rgb_img
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        img.load()
+        return img
+    
+    def analysis_image(self, img_path, img, original_size):
+        """The downscaled copy of an image that is analysed and hashed.
+        
+        Large JPEGs are always analysed from the reduced decode that
+        --jpeg-draft uses, so the pixels, and with them the answer cache
+        keys, are the same whether or not that flag is on. Without it this
+        costs one extra reduced decode; EXIF has already been read.
+        """
+        if not self.jpeg_draft and self.draft_reduces(original_size):
+            with Image.open(img_path) as original:
+                if original.format == 'JPEG':
+                    original.draft('RGB', self.draft_size(original.size))
+                    img = self.upright_rgb(original)
+        return self.resize(img, ANALYSIS_MAX_SIZE)
+    
+    def draft_reduces(self, size):
+        """Whether libjpeg would actually decode a JPEG this size at a reduced scale."""
+        draft_size = self.draft_size(size)
+        # Pillow only scales by 1/2, 1/4 or 1/8, and only when both sides allow it
+        return bool(draft_size) and min(size[0] // draft_size[0], size[1] // draft_size[1]) >= 2
+    
+    def draft_size(self, size):
+        """Smallest decode size that still covers the largest thumbnail, or None."""
+        max_size = max(box for box, _, _ in self.sizes.values())
+        scale = max_size / max(size)
+        if scale >= 1:
+            return None
+        return (max(1, math.ceil(size[0] * scale)), max(1, math.ceil(size[1] * scale)))
+    
+    def extract_exif_data(self, img_path, img=None):
+        """Extract comprehensive EXIF data including GPS.
+        
+        JPEGs go through read_exif_tags(), which only touches the EXIF
+        segment; other files are left to Pillow. Either way only EXIF_TAGS
+        are looked at.
+        """
         exif_data = {
             'camera': {},
             'settings': {},
@@ -224,13 +1086,19 @@ class SmartPhotoManager:
         }
         
         try:
-            img = Image.open(img_path)
-            exif = img._getexif()
+            tags = self.read_exif_tags(img_path, img)
+        except Exception:
+            tags = None
+        
+        try:
+            if tags is None:
+                if img is None:
+                    img = Image.open(img_path)
+                exif = img._getexif() or {}
+                tags = [(tag, exif[tag_id]) for _, tag_id, tag in EXIF_TAGS if tag_id in exif]
             
-            if exif:
-                for tag_id, value in exif.items():
-                    tag = TAGS.get(tag_id, tag_id)
-                    
+            if tags:
+                for tag, value in tags:
                     # Camera info
                     if tag == 'Make':
                         exif_data['camera']['make'] = str(value).strip()
@@ -319,6 +1187,64 @@ class SmartPhotoManager:
         
         return exif_data
     
+    def read_exif_tags(self, img_path, img=None):
+        """Read EXIF_TAGS from a JPEG's EXIF segment with piexif, without decoding pixels.
+        
+        Uses the segment Pillow already read when img is given, otherwise
+        read_exif_segment(). Returns [(tag name, value)], or None if this
+        isn't a JPEG.
+        """
+        if img is not None:
+            if img.format != 'JPEG':
+                return None
+            segment = img.info.get('exif', b'')
+        else:
+            segment = self.read_exif_segment(img_path)
+            if segment is None:
+                return None
+        if not segment:
+            return []
+        
+        def text(value):
+            # piexif leaves ASCII values as bytes; Pillow gives str
+            return value.decode('latin-1', 'replace') if isinstance(value, bytes) else value
+        
+        exif = piexif.load(segment)
+        tags = []
+        for ifd, tag_id, tag in EXIF_TAGS:
+            if ifd == 'GPS':
+                if exif.get('GPS'):
+                    tags.append((tag, {key: text(value) for key, value in exif['GPS'].items()}))
+            elif tag_id in exif.get(ifd, {}):
+                tags.append((tag, text(exif[ifd][tag_id])))
+        return tags
+    
+    def read_exif_segment(self, img_path):
+        """Return a JPEG's EXIF (APP1) segment, reading segment headers only.
+        
+        Stops at the start of the image data, so at most the metadata at the
+        front of the file is read. Returns b'' for a JPEG without EXIF and
+        None if the file isn't a JPEG.
+        """
+        with open(img_path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                header = f.read(4)
+                if len(header) < 4 or header[0] != 0xFF:
+                    return b''
+                marker = header[1]
+                length = int.from_bytes(header[2:], 'big')
+                # Start of scan or end of image: no metadata beyond this point
+                if marker in (0xDA, 0xD9):
+                    return b''
+                if marker == 0xE1:
+                    segment = f.read(length - 2)
+                    if segment.startswith(b'Exif\x00\x00'):
+                        return segment
+                else:
+                    f.seek(length - 2, os.SEEK_CUR)
+    
     def get_location_name(self, lat, lon):
         """Get location name from coordinates (returns coordinates if can't resolve)."""
         # For now, just return formatted coordinates
@@ -356,88 +1282,697 @@ class SmartPhotoManager:
         except:
             return 0
     
-    def generate_thumbnails(self, img_path):
-        """Generate thumbnails for an image."""
-        with Image.open(img_path) as img:
-            # Handle EXIF orientation
+    def generate_thumbnails(self, img_path, img=None, original_size=None, previous=None):
+        """Generate thumbnails for an image.
+        
+        img is the upright RGB image from open_image(); it is decoded here if
+        not supplied. In cascade mode the largest size is resampled from the
+        original and each smaller size from the one above it.
+        
+        Returns a dict with the thumbnail sizes, the original size, the
+        encodings (quality of every --format copy, None without --format),
+        the BlurHash and dominant color placeholders and the dHash. previous
+        is the encodings recorded for the same file by an earlier run; its
+        qualities are reused if the quality target hasn't changed.
+        """
+        if img is None:
+            _, img, original_size = self.open_image(img_path)
+        
+        target = self.quality_target_label()
+        reuse = previous if previous and previous.get('target') == target else {}
+        encodings = {'target': target} if self.formats else None
+        
+        results = {}
+        source = img
+        for size_name, (max_size, _, quality) in sorted(
+                self.sizes.items(), key=lambda item: item[1][0], reverse=True):
+            thumb = self.resize(source if self.thumbnail_mode == 'cascade' else img, max_size)
+            
+            if self.thumbnail_mode == 'cascade' and self.cascade_check and source is not img:
+                direct = self.resize(img, max_size)
+                psnr = self.psnr(thumb, direct)
+                if psnr < CASCADE_MIN_PSNR:
+                    print(f"  ⚠️  Cascaded {size_name} thumbnail only {psnr:.1f} dB PSNR, "
+                          "resampling from the original")
+                    thumb = direct
+            
+            thumb_path = self.thumb_dir / f"{img_path.stem}_{size_name}.jpg"
+            thumb.save(thumb_path, "JPEG", quality=quality, optimize=True, progressive=True)
+            
+            for fmt in self.formats:
+                data, choice = self.encode_thumbnail(thumb, fmt, reuse.get(fmt, {}).get(size_name))
+                (self.thumb_dir / f"{img_path.stem}_{size_name}.{fmt}").write_bytes(data)
+                encodings.setdefault(fmt, {})[size_name] = choice
+            
+            results[size_name] = thumb.size
+            source = thumb
+        
+        # Keep the configured size order so gallery_metadata.json stays stable
+        results = {size_name: results[size_name] for size_name in self.sizes}
+        if encodings:
+            for fmt in self.formats:
+                encodings[fmt] = {size_name: encodings[fmt][size_name] for size_name in self.sizes}
+        
+        # The last thumbnail made is the smallest; placeholders and the
+        # dHash start from it
+        blur_hash, color = self.placeholders(source)
+        return {
+            'thumbnail_sizes': results,
+            'original_size': original_size or img.size,
+            'encodings': encodings,
+            'blur_hash': blur_hash,
+            'color': color,
+            'dhash': self.dhash(source),
+        }
+    
+    def placeholders(self, thumb):
+        """BlurHash string and dominant '#rrggbb' color for a thumbnail."""
+        small = thumb.copy()
+        small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.Resampling.BOX)
+        pixels = np.asarray(small.convert('RGB'), dtype=np.float64)
+        return self.blur_hash(pixels), self.dominant_color(pixels)
+    
+    def dhash(self, img):
+        """64-bit difference hash as 16 hex digits: whether each pixel of a
+        9x8 greyscale copy is darker than its right-hand neighbour."""
+        small = img.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.LANCZOS)
+        pixels = np.asarray(small, dtype=np.int16)
+        return bytes(np.packbits(pixels[:, :-1] > pixels[:, 1:])).hex()
+    
+    def near_duplicates(self, filename, dhash):
+        """[(distance, filename)] of other photos near-duplicating dhash, closest first.
+        
+        Covers the gallery entries and the photos of this run that were
+        checked but aren't recorded yet (see duplicate_source()).
+        """
+        value = int(dhash, 16)
+        with self.metadata_lock:
+            if self.duplicate_index is None:
+                self.duplicate_index = HashIndex()
+                for name, entry in self.metadata.items():
+                    if entry.get('dhash'):
+                        self.duplicate_index.add(int(entry['dhash'], 16), name)
+                for name, pending in self.pending_dhashes.items():
+                    self.duplicate_index.add(int(pending, 16), name)
+            
+            # The index never drops a hash, so skip ones a photo no longer has
+            closest = {}
+            for distance, name in self.duplicate_index.search(value):
+                current = {self.metadata.get(name, {}).get('dhash'), self.pending_dhashes.get(name)} - {None}
+                if name != filename and any(hamming(int(other, 16), value) == distance for other in current):
+                    closest[name] = min(distance, closest.get(name, distance))
+            return sorted((distance, name) for name, distance in closest.items())
+    
+    def duplicate_source(self, img_path, dhash):
+        """Flag a near-duplicate of an earlier photo before inference.
+        
+        Earlier photos include those of the same batch, or still on their
+        way through --pipeline. Returns the photo whose analysis to reuse
+        with --reuse-duplicates, else None. Either way img_path is then
+        looked up by the photos after it.
+        """
+        if not dhash:
+            return None
+        source = None
+        for distance, name in self.near_duplicates(img_path.name, dhash):
+            if name not in self.pending_analyses and not self.metadata.get(name, {}).get('ai_analysis'):
+                continue
+            if self.reuse_duplicates:
+                print(f"  ♻️  {img_path.name} is a near-duplicate of {name} (distance {distance}); reusing its analysis")
+                source = name
+            else:
+                print(f"  👯 {img_path.name} looks like a near-duplicate of {name} (distance {distance})")
+            break
+        
+        with self.metadata_lock:
+            self.pending_dhashes[img_path.name] = dhash
+            self.pending_analyses.setdefault(img_path.name, None)
+            self.duplicate_index.add(int(dhash, 16), img_path.name)
+        return source
+    
+    def duplicate_analysis(self, source):
+        """A copy of source's analysis: from this run if it has one, else its entry's."""
+        with self.metadata_lock:
+            ai_analysis = self.pending_analyses.get(source) or self.metadata.get(source, {}).get('ai_analysis')
+        return json.loads(json.dumps(ai_analysis)) if ai_analysis else None
+    
+    def remember_analysis(self, img_path, ai_analysis):
+        """Make a photo's analysis reusable by its near-duplicates before it is recorded."""
+        with self.metadata_lock:
+            if img_path.name in self.pending_analyses:
+                self.pending_analyses[img_path.name] = ai_analysis
+    
+    def report_duplicates(self):
+        """Print groups of near-duplicate photos in the library."""
+        hashed = sorted(name for name, entry in self.metadata.items() if entry.get('dhash'))
+        missing = len(self.metadata) - len(hashed)
+        if missing:
+            print(f"⚠️  {missing} photo(s) have no dHash yet; run with --refresh dhash to add them")
+        
+        # Connected components of the near-duplicate graph
+        group_of = {}
+        groups = []
+        for name in hashed:
+            if name in group_of:
+                continue
+            group, stack = [], [name]
+            group_of[name] = group
+            while stack:
+                current = stack.pop()
+                group.append(current)
+                for _, other in self.near_duplicates(current, self.metadata[current]['dhash']):
+                    if other not in group_of:
+                        group_of[other] = group
+                        stack.append(other)
+            if len(group) > 1:
+                groups.append(sorted(group))
+        
+        print(f"👯 {len(groups)} group(s) of near-duplicates (dHash distance ≤ {NEAR_DUPLICATE_DISTANCE}):")
+        for group in groups:
+            base = int(self.metadata[group[0]]['dhash'], 16)
+            print(f"  • {group[0]}")
+            for name in group[1:]:
+                print(f"    {hamming(base, int(self.metadata[name]['dhash'], 16)):2d}  {name}")
+    
+    def blur_hash(self, pixels):
+        """Encode an (height, width, 3) sRGB array as a BlurHash (https://blurha.sh)."""
+        height, width = pixels.shape[:2]
+        x_components, y_components = BLURHASH_COMPONENTS
+        if height > width:
+            x_components, y_components = y_components, x_components
+        
+        # sRGB to linear light, then every cosine component in one contraction
+        values = pixels / 255
+        linear = np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+        basis_x = np.cos(np.pi * np.outer(np.arange(x_components), np.arange(width)) / width)
+        basis_y = np.cos(np.pi * np.outer(np.arange(y_components), np.arange(height)) / height)
+        factors = np.einsum('jy,ix,yxc->jic', basis_y, basis_x, linear) * 2 / (width * height)
+        factors[0, 0] /= 2
+        factors = factors.reshape(-1, 3)
+        dc, ac = factors[0], factors[1:]
+        
+        def base83(value, length):
+            return ''.join(BASE83[value // 83 ** (length - i - 1) % 83] for i in range(length))
+        
+        def to_srgb(value):
+            value = min(max(value, 0.0), 1.0)
+            if value <= 0.0031308:
+                return int(value * 12.92 * 255 + 0.5)
+            return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+        
+        encoded = base83((x_components - 1) + (y_components - 1) * 9, 1)
+        if len(ac):
+            quantised_max = int(max(0, min(82, math.floor(np.abs(ac).max() * 166 - 0.5))))
+            max_value = (quantised_max + 1) / 166
+        else:
+            quantised_max, max_value = 0, 1
+        encoded += base83(quantised_max, 1)
+        
+        red, green, blue = (to_srgb(value) for value in dc)
+        encoded += base83((red << 16) + (green << 8) + blue, 4)
+        
+        quantised = np.floor(np.sign(ac) * np.abs(ac / max_value) ** 0.5 * 9 + 9.5)
+        quantised = np.clip(quantised, 0, 18).astype(int)
+        for red, green, blue in quantised:
+            encoded += base83(int(red * 19 * 19 + green * 19 + blue), 2)
+        return encoded
+    
+    def dominant_color(self, pixels):
+        """Mean color of the most common 32-level RGB bucket, as '#rrggbb'."""
+        flat = pixels.reshape(-1, 3)
+        buckets = flat.astype(int) // 32
+        keys = buckets[:, 0] * 64 + buckets[:, 1] * 8 + buckets[:, 2]
+        mode = np.bincount(keys, minlength=512).argmax()
+        red, green, blue = flat[keys == mode].mean(axis=0).round().astype(int)
+        return f"#{red:02x}{green:02x}{blue:02x}"
+    
+    def update_thumbnails(self, image_files):
+        """Regenerate missing thumbnails (and --format copies) of unchanged photos.
+        
+        Only the files are rebuilt, from the original; the entry keeps its
+        analysis, and recorded --format qualities are reused.
+        """
+        missing = sorted(
+            img_path for img_path in image_files
+            if img_path.name in self.metadata and not self.thumbnails_exist(img_path)
+        )
+        if not missing:
+            return
+        
+        print(f"\n🖼️  Regenerating missing thumbnails for {len(missing)} photo(s)...")
+        for img_path in missing:
+            entry = self.metadata[img_path.name]
             try:
-                from PIL import ImageOps
-                img = ImageOps.exif_transpose(img)
-            except:
-                pass
+                _, img, original_size = self.open_image(img_path)
+                thumbnails = self.generate_thumbnails(img_path, img, original_size, entry.get('encodings'))
+            except Exception as e:
+                print(f"  ⚠️  {img_path.name}: {e}")
+                continue
+            
+            with self.metadata_lock:
+                for field in ('thumbnail_sizes', 'original_size', 'blur_hash', 'color', 'dhash'):
+                    entry[field] = thumbnails[field]
+                if thumbnails['encodings']:
+                    entry['encodings'] = thumbnails['encodings']
+                self.store_entry(img_path.name, checkpoint=False)
+    
+    def update_renditions(self):
+        """Give every photo a resized JPEG for each --srcset-widths width.
+        
+        Rendition names are content-addressed (see rendition_name()), so an
+        existing file is always current: adding a width encodes just that
+        width, a changed original gets new files, and renditions nothing
+        refers to any more are removed. New photos normally have theirs
+        already (see prepare_image()); this pass backfills the rest and
+        records every photo's srcset.
+        """
+        if not self.srcset_widths:
+            return
+        
+        print(f"\n🖼️  Checking srcset renditions ({', '.join(map(str, self.srcset_widths))}w)...")
+        self.srcset_dir.mkdir(parents=True, exist_ok=True)
+        created = 0
+        referenced = set()
+        
+        for filename, entry in sorted(self.metadata.items()):
+            img_path = self.source_dir / filename
+            if not entry.get('hash') or not entry.get('original_size'):
+                continue
             
-            # Convert to RGB if needed
-            if img.mode in ('RGBA', 'LA', 'P'):
-                rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'RGBA':
-                    rgb_img.paste(img, mask=img.split()[-1])
+            wanted = {
+                width: self.rendition_name(img_path, entry['hash'], width)
+                for width in self.rendition_widths(entry['original_size'][0])
+            }
+            missing = [width for width, name in wanted.items() if not (self.srcset_dir / name).exists()]
+            if missing and img_path.exists():
+                # Renditions can be as wide as the original, so no draft decoding
+                _, img, _ = self.open_image(img_path, draft=False)
+                created += self.write_renditions(img_path, entry['hash'], img)
+            
+            renditions = {
+                str(width): name for width, name in wanted.items()
+                if (self.srcset_dir / name).exists()
+            }
+            referenced.update(renditions.values())
+            if entry.get('srcset') != renditions:
+                with self.metadata_lock:
+                    entry['srcset'] = renditions
+                    self.store_entry(filename, checkpoint=False)
+        
+        removed = 0
+        for path in self.srcset_dir.iterdir():
+            if path.name not in referenced:
+                path.unlink()
+                removed += 1
+        
+        print(f"  ✅ {created} rendition(s) created, {removed} stale rendition(s) removed")
+    
+    def write_renditions(self, img_path, file_hash, img):
+        """Encode the srcset renditions an image is missing; returns how many.
+        
+        img must be the full-size decode of the original, so a rendition's
+        bytes don't depend on which pass made it.
+        """
+        if not self.srcset_widths or not file_hash:
+            return 0
+        self.srcset_dir.mkdir(parents=True, exist_ok=True)
+        created = 0
+        for width in self.rendition_widths(img.width):
+            path = self.srcset_dir / self.rendition_name(img_path, file_hash, width)
+            if path.exists():
+                continue
+            rendition = img
+            if width < img.width:
+                height = max(1, round(img.height * width / img.width))
+                rendition = img.resize((width, height), Image.Resampling.LANCZOS)
+            rendition.save(path, "JPEG", quality=SRCSET_QUALITY, optimize=True, progressive=True)
+            created += 1
+        return created
+    
+    def rendition_widths(self, original_width):
+        """The srcset ladder for a photo, never wider than the photo itself."""
+        return sorted({min(width, original_width) for width in self.srcset_widths})
+    
+    def rendition_name(self, img_path, file_hash, width):
+        """File name of a rendition, keyed by everything its bytes depend on."""
+        key = hashlib.md5(f"{file_hash}:{width}:{SRCSET_QUALITY}:lanczos".encode('utf-8')).hexdigest()[:12]
+        return f"{img_path.stem}_{width}w_{key}.jpg"
+    
+    def quality_target_label(self):
+        if self.quality_target is None:
+            return None
+        kind, goal = self.quality_target
+        return f"{kind}:{goal}"
+    
+    def encode_thumbnail(self, thumb, fmt, previous=None):
+        """Encode a thumbnail as WebP or AVIF; returns (bytes, recorded choice).
+        
+        previous is the choice an earlier run made for this thumbnail, whose
+        quality is used as-is instead of searching again.
+        """
+        def encode(quality):
+            buffer = io.BytesIO()
+            thumb.save(buffer, fmt.upper(), quality=quality, **FORMAT_OPTIONS[fmt])
+            return buffer.getvalue()
+        
+        measured = None
+        if previous:
+            quality = previous['quality']
+            measured = previous.get('ssim')
+        elif self.quality_target is None:
+            quality = FORMAT_QUALITY[fmt]
+        else:
+            quality, measured = self.search_quality(thumb, encode)
+        
+        data = encode(quality)
+        choice = {'quality': quality, 'bytes': len(data)}
+        if measured is not None:
+            choice['ssim'] = measured
+        return data, choice
+    
+    def search_quality(self, thumb, encode):
+        """Binary-search the encoder quality for the quality target.
+        
+        For 'ssim' this finds the lowest quality whose decoded output reaches
+        the target SSIM against thumb, for 'bytes' the highest quality that
+        fits the budget. Returns (quality, SSIM or None); if no quality in
+        QUALITY_SEARCH_RANGE qualifies, the nearest end of it is used.
+        """
+        kind, goal = self.quality_target
+        low, high = QUALITY_SEARCH_RANGE
+        reference = self.luma(thumb) if kind == 'ssim' else None
+        best, best_ssim = None, None
+        
+        while low <= high:
+            quality = (low + high) // 2
+            data = encode(quality)
+            if kind == 'ssim':
+                with Image.open(io.BytesIO(data)) as decoded:
+                    ssim = self.ssim(reference, self.luma(decoded))
+                if ssim >= goal:
+                    best, best_ssim = quality, round(ssim, 4)
+                    high = quality - 1
                 else:
-                    rgb_img.paste(img)
-                img = rgb_img
+                    low = quality + 1
+            elif len(data) <= goal:
+                best = quality
+                low = quality + 1
+            else:
+                high = quality - 1
+        
+        if best is None:
+            best = QUALITY_SEARCH_RANGE[1] if kind == 'ssim' else QUALITY_SEARCH_RANGE[0]
+        return best, best_ssim
+    
+    def luma(self, img):
+        return np.asarray(img.convert('L'), dtype=np.float64)
+    
+    def ssim(self, luma_a, luma_b):
+        """Mean SSIM between two same-sized luma arrays, over SSIM_BLOCK-pixel blocks."""
+        height = luma_a.shape[0] // SSIM_BLOCK * SSIM_BLOCK
+        width = luma_a.shape[1] // SSIM_BLOCK * SSIM_BLOCK
+        shape = (height // SSIM_BLOCK, SSIM_BLOCK, width // SSIM_BLOCK, SSIM_BLOCK)
+        a = luma_a[:height, :width].reshape(shape)
+        b = luma_b[:height, :width].reshape(shape)
+        
+        mean_a = a.mean(axis=(1, 3))
+        mean_b = b.mean(axis=(1, 3))
+        var_a = a.var(axis=(1, 3))
+        var_b = b.var(axis=(1, 3))
+        covariance = (a * b).mean(axis=(1, 3)) - mean_a * mean_b
+        
+        c1 = (0.01 * 255) ** 2
+        c2 = (0.03 * 255) ** 2
+        ssim = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / (
+            (mean_a ** 2 + mean_b ** 2 + c1) * (var_a + var_b + c2))
+        return float(ssim.mean())
+    
+    def resize(self, img, max_size):
+        """Fit an image inside a max_size square with LANCZOS, as thumbnails use."""
+        thumb = img.copy()
+        thumb.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        return thumb
+    
+    def psnr(self, img_a, img_b):
+        """Peak signal-to-noise ratio in dB between two same-sized RGB images."""
+        if img_a.size != img_b.size:
+            img_b = img_b.resize(img_a.size, Image.Resampling.LANCZOS)
+        rms = ImageStat.Stat(ImageChops.difference(img_a, img_b)).rms
+        mse = sum(value * value for value in rms) / len(rms)
+        if mse == 0:
+            return float('inf')
+        return 10 * math.log10(255 * 255 / mse)
+    
+    def file_hash(self, img_path, algorithm=None):
+        """Hash a file in fixed-size chunks so large originals never sit in memory."""
+        algorithm = algorithm or self.hash_algorithm
+        known = self.known_hashes.get((str(img_path), algorithm))
+        if known:
+            return known
+        
+        if algorithm == 'xxh64':
+            import xxhash
+            digest = xxhash.xxh64()
+        else:
+            digest = hashlib.new(algorithm)
+        
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(img_path, 'rb') as f:
+            while True:
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                digest.update(view[:size])
+        
+        return digest.hexdigest()
+    
+    def thumbnails_exist(self, img_path):
+        """Check that every thumbnail size has been generated for an image."""
+        return all(
+            (self.thumb_dir / f"{img_path.stem}_{size}.{fmt}").exists()
+            for size in self.sizes.keys()
+            for fmt in ['jpg', *self.formats]
+        )
+    
+    def needs_processing(self, img_path):
+        """Return the file hash if the image is new or changed, otherwise None.
+        
+        Missing thumbnails of an unchanged image don't count; they are
+        regenerated by update_thumbnails() without analysing it again.
+        """
+        entry = self.metadata.get(img_path.name)
+        stat = img_path.stat()
+        
+        if entry:
+            # Fast path: same size and mtime as last time means no need to hash
+            if self.file_stats.matches(img_path, stat, entry.get('hash')):
+                return None
             
-            results = {}
-            for size_name, (max_size, _, quality) in self.sizes.items():
-                thumb = img.copy()
-                thumb.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-                
-                thumb_path = self.thumb_dir / f"{img_path.stem}_{size_name}.jpg"
-                thumb.save(thumb_path, "JPEG", quality=quality, optimize=True, progressive=True)
-                
-                results[size_name] = thumb.size
+            recorded_algorithm = entry.get('hash_algorithm', 'md5')
+            file_hash = self.file_hash(img_path, recorded_algorithm)
+            if entry.get('hash') == file_hash:
+                # Unchanged: remember size and mtime so the next run skips hashing
+                with self.metadata_lock:
+                    self.file_stats.record(img_path, file_hash, stat)
+                return None
             
-            return results, img.size
+            if recorded_algorithm == self.hash_algorithm:
+                return file_hash
+        
+        return self.file_hash(img_path)
     
-    def process_image(self, img_path):
-        """Process a single image."""
-        # Check if already processed
-        file_hash = hashlib.md5(img_path.read_bytes()).hexdigest()
-        
-        if img_path.name in self.metadata:
-            if self.metadata[img_path.name].get('hash') == file_hash:
-                # Check if thumbnails exist
-                all_exist = all(
-                    (self.thumb_dir / f"{img_path.stem}_{size}.jpg").exists()
-                    for size in self.sizes.keys()
+    def prepare_image(self, img_path, previous=None, file_hash=None):
+        """Do the CPU-bound work for one image: decode, EXIF and thumbnails.
+        
+        Runs in a worker process under --jobs, so it only returns plain data
+        plus a downscaled copy of the image for analysis. previous is passed
+        on to generate_thumbnails(). With file_hash, srcset renditions are
+        made from the same decode, unless it is a reduced --jpeg-draft one.
+        """
+        exif_data, img, original_size = self.open_image(img_path)
+        prepared = self.generate_thumbnails(img_path, img, original_size, previous)
+        if img.size == tuple(original_size):
+            self.write_renditions(img_path, file_hash, img)
+        prepared.update(exif=exif_data, analysis_image=self.analysis_image(img_path, img, original_size))
+        return prepared
+    
+    def previous_encodings(self, img_path, file_hash):
+        """Encodings recorded for this exact file by an earlier run, if any."""
+        entry = self.metadata.get(img_path.name)
+        if entry and entry.get('hash') == file_hash:
+            return entry.get('encodings')
+        return None
+    
+    def worker_settings(self):
+        """Constructor arguments that --jobs workers need to prepare images."""
+        return {
+            'hash_algorithm': self.hash_algorithm,
+            'thumbnail_mode': self.thumbnail_mode,
+            'jpeg_draft': self.jpeg_draft,
+            'cascade_check': self.cascade_check,
+            'formats': self.formats,
+            'target_ssim': self.target_ssim,
+            'target_bytes': self.target_bytes,
+            'srcset_widths': self.srcset_widths,
+        }
+    
+    def find_pending(self, image_files, executor=None):
+        """Return (path, hash) for every new or changed image, in sorted order."""
+        image_files = sorted(image_files)
+        
+        if executor is not None:
+            # Hash everything the size/mtime fast path can't rule out in parallel
+            to_hash = []
+            for img_path in image_files:
+                entry = self.metadata.get(img_path.name)
+                stat = img_path.stat()
+                if entry and self.file_stats.matches(img_path, stat, entry.get('hash')):
+                    continue
+                algorithm = entry.get('hash_algorithm', 'md5') if entry else self.hash_algorithm
+                to_hash.append((img_path, algorithm))
+            
+            hashes = executor.map(
+                hash_in_worker, [path for path, _ in to_hash], [algo for _, algo in to_hash]
+            )
+            for (img_path, algorithm), file_hash in zip(to_hash, hashes):
+                self.known_hashes[(str(img_path), algorithm)] = file_hash
+        
+        pending = []
+        for img_path in image_files:
+            file_hash = self.needs_processing(img_path)
+            if file_hash is not None:
+                pending.append((img_path, file_hash))
+        return pending
+    
+    def prepared_images(self, pending, executor=None):
+        """Yield (path, hash, prepared) in order, preparing ahead in workers.
+        
+        At most two images per worker are in flight, so finished results
+        never pile up while the parent process is busy with inference.
+        """
+        if executor is None:
+            for img_path, file_hash in pending:
+                yield img_path, file_hash, self.prepare_image(
+                    img_path, self.previous_encodings(img_path, file_hash), file_hash
+                )
+            return
+        
+        in_flight = deque()
+        remaining = iter(pending)
+        for img_path, file_hash in remaining:
+            in_flight.append((img_path, file_hash, executor.submit(
+                prepare_in_worker, img_path, self.previous_encodings(img_path, file_hash), file_hash
+            )))
+            if len(in_flight) >= self.jobs * 2:
+                break
+        
+        while in_flight:
+            img_path, file_hash, future = in_flight.popleft()
+            next_item = next(remaining, None)
+            if next_item is not None:
+                in_flight.append((*next_item, executor.submit(
+                    prepare_in_worker, next_item[0], self.previous_encodings(*next_item), next_item[1]
+                )))
+            yield img_path, file_hash, future.result()
+    
+    def process_batch(self, batch):
+        """Analyse and record a batch of prepared images; returns how many were processed."""
+        analyses = [None] * len(batch)
+        if self.batch_size > 1:
+            # Near-duplicates are checked first, also against earlier photos
+            # of this batch; reused analyses skip inference
+            sources = [self.duplicate_source(img_path, prepared.get('dhash')) for img_path, _, prepared in batch]
+            todo = [index for index, source in enumerate(sources) if source is None]
+            if todo:
+                print(f"\n🤖 Understanding {len(todo)} images in one batch...")
+                understood = self.understand_images(
+                    [batch[index][0] for index in todo],
+                    [batch[index][2]['analysis_image'] for index in todo]
                 )
-                if all_exist:
-                    return False
+                for index, ai_analysis in zip(todo, understood):
+                    analyses[index] = ai_analysis
+                    self.remember_analysis(batch[index][0], ai_analysis)
+            # In batch order, so a reused analysis can itself be reused
+            for index, source in enumerate(sources):
+                if source is not None:
+                    analyses[index] = self.duplicate_analysis(source)
+                    self.remember_analysis(batch[index][0], analyses[index])
+        
+        processed = 0
+        for (img_path, file_hash, prepared), ai_analysis in zip(batch, analyses):
+            if self.process_image(img_path, file_hash=file_hash, ai_analysis=ai_analysis, prepared=prepared):
+                processed += 1
+        return processed
+    
+    def process_image(self, img_path, file_hash=None, ai_analysis=None, prepared=None):
+        """Process a single image.
+        
+        file_hash, ai_analysis and prepared (the prepare_image() result) may
+        be supplied by run() when the skip check, a batched analysis or the
+        CPU-bound stages have already been done for this image.
+        """
+        # Check if already processed
+        if file_hash is None:
+            file_hash = self.needs_processing(img_path)
+            if file_hash is None:
+                return False
         
         print(f"\n📷 Processing {img_path.name}")
         
-        # Extract EXIF data
-        print("  📍 Extracting EXIF data...")
-        exif_data = self.extract_exif_data(img_path)
+        # Read and decode the file once; EXIF, thumbnails and analysis share it
+        if prepared is None:
+            print("  📍 Extracting EXIF data and generating thumbnails...")
+            prepared = self.prepare_image(img_path, self.previous_encodings(img_path, file_hash), file_hash)
+        exif_data = prepared['exif']
         
-        # AI analysis
-        print("  🤖 Understanding image content...")
-        ai_analysis = self.understand_image(img_path)
+        # AI analysis, unless it can come from a near-duplicate
+        if ai_analysis is None:
+            source = self.duplicate_source(img_path, prepared.get('dhash'))
+            if source is not None:
+                ai_analysis = self.duplicate_analysis(source)
+        if ai_analysis is None:
+            print("  🤖 Understanding image content...")
+            ai_analysis = self.understand_image(img_path, prepared['analysis_image'])
+        
+        self.record_image(img_path, file_hash, ai_analysis, prepared)
+        return True
+    
+    def record_image(self, img_path, file_hash, ai_analysis, prepared):
+        """Categorize an analysed image and store its gallery metadata entry."""
+        exif_data = prepared['exif']
         
         # Smart categorization
         category = self.categorize_from_ai(ai_analysis, exif_data)
         
-        # Use creative AI title or caption
-        title = ai_analysis.get('title', ai_analysis.get('caption', 'Photo'))
-        if title and len(title) > 50:
-            title = title[:47] + "..."
-        
-        # Generate thumbnails
-        print("  🖼️  Generating thumbnails...")
-        thumb_sizes, original_size = self.generate_thumbnails(img_path)
-        
         # Create metadata
-        self.metadata[img_path.name] = {
+        entry = {
             'filename': img_path.name,
-            'title': title,
+            'title': self.title_from_ai(ai_analysis),
             'description': ai_analysis.get('caption', ''),
             'category': category,
             'keywords': ai_analysis.get('keywords', []),
-            'original_size': original_size,
-            'thumbnail_sizes': thumb_sizes,
+            'original_size': prepared['original_size'],
+            'thumbnail_sizes': prepared['thumbnail_sizes'],
+            'blur_hash': prepared.get('blur_hash'),
+            'color': prepared.get('color'),
+            'dhash': prepared.get('dhash'),
             'exif': exif_data,
             'ai_analysis': ai_analysis,
             'hash': file_hash,
+            'hash_algorithm': self.hash_algorithm,
             'processed': datetime.now().isoformat()
         }
+        if prepared.get('encodings'):
+            entry['encodings'] = prepared['encodings']
+        with self.metadata_lock:
+            self.metadata[img_path.name] = entry
+            self.store_entry(img_path.name)
+            self.file_stats.record(img_path, file_hash)
+            if self.duplicate_index is not None and entry['dhash']:
+                self.duplicate_index.add(int(entry['dhash'], 16), img_path.name)
+            self.pending_dhashes.pop(img_path.name, None)
+            self.pending_analyses.pop(img_path.name, None)
         
         # Display info
         print(f"  🏷️  Category: {category}")
@@ -450,14 +1985,463 @@ class SmartPhotoManager:
             camera = f"{exif_data['camera'].get('make', '')} {exif_data['camera'].get('model', '')}"
             if camera.strip():
                 print(f"  📷 Camera: {camera}")
+    
+    def reconcile(self, image_files):
+        """Match the metadata and thumbnails up with the originals on disk.
         
-        return True
+        An entry whose original is gone but whose hash matches a new file is
+        a rename: the entry, its analysis and its thumbnails move to the new
+        name and nothing is recomputed. Entries still without an original,
+        and thumbnails and renditions no entry owns, are reported, and
+        removed with --prune.
+        """
+        present = {img_path.name: img_path for img_path in image_files}
+        missing = [filename for filename in sorted(self.metadata) if filename not in present]
+        new_files = [img_path for name, img_path in sorted(present.items()) if name not in self.metadata]
+        
+        # Renames: a new file with the same content as an entry that lost its original
+        by_hash = {}
+        for filename in missing:
+            entry = self.metadata[filename]
+            if entry.get('hash'):
+                by_hash.setdefault((entry.get('hash_algorithm', 'md5'), entry['hash']), filename)
+        
+        renames = []
+        for img_path in new_files if by_hash else []:
+            for algorithm in {algorithm for algorithm, _ in by_hash}:
+                file_hash = self.file_hash(img_path, algorithm)
+                self.known_hashes[(str(img_path), algorithm)] = file_hash
+                old = by_hash.pop((algorithm, file_hash), None)
+                if old:
+                    renames.append((old, img_path))
+                    break
+        
+        for old, img_path in renames:
+            print(f"  🔁 {old} → {img_path.name} (same content, keeping its analysis)")
+            if not self.dry_run:
+                self.rename_entry(old, img_path)
+        
+        renamed = {old for old, _ in renames}
+        orphaned = [filename for filename in missing if filename not in renamed]
+        owned = [entry for filename, entry in self.metadata.items() if filename not in orphaned]
+        
+        # Thumbnails and srcset renditions that no remaining entry owns. A
+        # WebP/AVIF copy is only owned while its entry's encodings list that
+        # format; a photo reprocessed without --format leaves stale ones
+        owned_formats = {
+            Path(entry.get('filename', '')).stem: {'jpg', *(entry.get('encodings') or {})}
+            for entry in owned
+        }
+        pattern = re.compile(rf"^(.*)_({'|'.join(map(re.escape, self.sizes))})\.(jpg|webp|avif)$")
+        stray = []
+        if self.thumb_dir.exists():
+            for path in sorted(self.thumb_dir.iterdir()):
+                match = pattern.match(path.name)
+                if match and match.group(3) not in owned_formats.get(match.group(1), ()):
+                    stray.append(path)
+        if self.srcset_dir.exists():
+            referenced = {name for entry in owned for name in (entry.get('srcset') or {}).values()}
+            stray.extend(path for path in sorted(self.srcset_dir.iterdir()) if path.name not in referenced)
+        
+        if not orphaned and not stray:
+            return
+        
+        stray_size = sum(path.stat().st_size for path in stray) / 1024 / 1024
+        print(f"  🧹 {len(orphaned)} metadata entries without an original, "
+              f"{len(stray)} orphaned thumbnail(s) ({stray_size:.1f} MB)")
+        for filename in orphaned:
+            print(f"     - {filename}")
+        
+        if self.dry_run:
+            for path in stray:
+                print(f"     - {path.relative_to(self.source_dir)}")
+            return
+        if not self.prune:
+            print("     Run with --prune to remove them (add --dry-run to preview)")
+            return
+        
+        with self.metadata_lock:
+            for filename in orphaned:
+                del self.metadata[filename]
+        for path in stray:
+            path.unlink()
+        print(f"  ✅ Pruned {len(orphaned)} entries and {len(stray)} thumbnail(s)")
+    
+    def rename_entry(self, old, img_path):
+        """Move an entry and its thumbnails from old to img_path's name."""
+        with self.metadata_lock:
+            entry = self.metadata.pop(old)
+            old_stem, new_stem = Path(old).stem, img_path.stem
+            for size_name in self.sizes:
+                for fmt in ['jpg', *FORMAT_QUALITY]:
+                    thumb_path = self.thumb_dir / f"{old_stem}_{size_name}.{fmt}"
+                    if thumb_path.exists():
+                        os.replace(thumb_path, self.thumb_dir / f"{new_stem}_{size_name}.{fmt}")
+            
+            # Rendition names include the stem; the content key stays valid
+            if entry.get('srcset'):
+                renditions = {}
+                for width, name in entry['srcset'].items():
+                    new_name = self.rendition_name(img_path, entry['hash'], int(width))
+                    if (self.srcset_dir / name).exists():
+                        os.replace(self.srcset_dir / name, self.srcset_dir / new_name)
+                    renditions[width] = new_name
+                entry['srcset'] = renditions
+            
+            self.embeddings.rename(old, img_path.name)
+            
+            entry['filename'] = img_path.name
+            self.file_stats.record(img_path, entry['hash'])
+            self.metadata[img_path.name] = entry
+            self.store_entry(img_path.name)
+    
+    def title_from_ai(self, ai_analysis):
+        """Use creative AI title or caption, cut to fit a card."""
+        title = ai_analysis.get('title', ai_analysis.get('caption', 'Photo'))
+        if title and len(title) > 50:
+            title = title[:47] + "..."
+        return title
+    
+    def refresh_order(self, stages):
+        """Expand stages with everything downstream in REFRESH_GRAPH, in dependency order."""
+        wanted = set()
+        pending = list(stages)
+        while pending:
+            stage = pending.pop()
+            if stage not in wanted:
+                wanted.add(stage)
+                pending.extend(REFRESH_GRAPH[stage])
+        return [stage for stage in REFRESH_GRAPH if stage in wanted]
+    
+    def run_refresh(self):
+        """Recompute the --refresh fields for every photo; returns how many entries changed."""
+        print(f"\n🔄 Refreshing {', '.join(self.refresh)} for {len(self.metadata)} photos")
+        changed = Counter()
+        entries = 0
+        
+        for filename, entry in sorted(self.metadata.items()):
+            img_path = self.source_dir / filename
+            before = json.dumps(entry, sort_keys=True)
+            for stage in self.refresh:
+                fields = getattr(self, f"refresh_{stage}")(img_path, entry)
+                for field, value in (fields or {}).items():
+                    if entry.get(field) != value:
+                        entry[field] = value
+                        changed[field] += 1
+            
+            if json.dumps(entry, sort_keys=True) != before:
+                entries += 1
+                with self.metadata_lock:
+                    self.store_entry(filename, checkpoint=False)
+        
+        summary = ', '.join(f"{field} ×{count}" for field, count in sorted(changed.items()))
+        print(f"  ✅ {entries} photo(s) changed" + (f" ({summary})" if summary else ""))
+        return entries
+    
+    def refresh_exif(self, img_path, entry):
+        if img_path.exists():
+            return {'exif': self.extract_exif_data(img_path)}
+    
+    def refresh_category(self, img_path, entry):
+        return {'category': self.categorize_from_ai(entry.get('ai_analysis', {}), entry.get('exif', {}))}
+    
+    def refresh_prototypes(self, img_path, entry):
+        # Only photos no keyword matched; keyword categories stay authoritative
+        if entry.get('category') != 'general' or img_path.name not in self.embeddings:
+            return
+        category, similarity = self.prototype_category(img_path.name)
+        if category and similarity >= PROTOTYPE_MIN_SIMILARITY:
+            return {'category': category}
+    
+    def prototype_category(self, filename):
+        """The category whose prototype is closest to a photo's embedding, and its similarity."""
+        if self.prototypes is None:
+            # Prototypes: mean embedding of the photos keyword matching categorizes
+            filenames, vectors = self.embeddings.vectors()
+            labels = [
+                self.categorize_from_ai(self.metadata.get(name, {}).get('ai_analysis', {}), {}, keywords_only=True)
+                for name in filenames
+            ]
+            categories = sorted({label for label in labels if label})
+            prototypes = np.zeros((len(categories), vectors.shape[1] if len(vectors) else 0), dtype=np.float32)
+            for row, category in enumerate(categories):
+                members = vectors[[label == category for label in labels]]
+                mean = members.mean(axis=0)
+                prototypes[row] = mean / (np.linalg.norm(mean) or 1)
+            self.prototypes = (categories, prototypes)
+        
+        categories, prototypes = self.prototypes
+        if not categories:
+            return None, 0.0
+        _, vector = self.embeddings.vectors([filename])
+        similarities = prototypes @ vector[0]
+        best = int(similarities.argmax())
+        return categories[best], float(similarities[best])
+    
+    def print_similar(self, filename, count):
+        """Print the photos whose embeddings are closest to filename's."""
+        if filename not in self.embeddings:
+            print(f"❌ No embedding for {filename}; run with --embed first")
+            return
+        _, vector = self.embeddings.vectors([filename])
+        print(f"🔍 Photos most similar to {filename}:")
+        for name, similarity in self.embeddings.nearest(vector[0], count, exclude=filename):
+            category = self.metadata.get(name, {}).get('category', '?')
+            print(f"  {similarity:6.3f}  {name} ({category})")
+    
+    def embed_missing(self):
+        """Encode every photo that has no embedding yet; runs the vision encoder only."""
+        missing = [
+            self.source_dir / filename for filename in sorted(self.metadata)
+            if filename not in self.embeddings and (self.source_dir / filename).exists()
+        ]
+        if not missing:
+            return
+        
+        print(f"\n🧭 Embedding {len(missing)} photo(s)...")
+        for start in range(0, len(missing), self.batch_size):
+            img_paths = missing[start:start + self.batch_size]
+            photos = [self.load_for_analysis(img_path) for img_path in img_paths]
+            try:
+                self.encode(photos)
+            except Exception as e:
+                print(f"  ⚠️  Could not embed: {e}")
+                return
+            for img_path, photo in zip(img_paths, photos):
+                self.embeddings.put(img_path.name, photo['embedding'])
+    
+    def refresh_title(self, img_path, entry):
+        return {'title': self.title_from_ai(entry.get('ai_analysis', {}))}
+    
+    def refresh_description(self, img_path, entry):
+        return {'description': entry.get('ai_analysis', {}).get('caption', '')}
+    
+    def refresh_keywords(self, img_path, entry):
+        return {'keywords': entry.get('ai_analysis', {}).get('keywords', [])}
+    
+    def refresh_placeholders(self, img_path, entry):
+        # Placeholders come from the smallest thumbnail, as in generate_thumbnails()
+        size_name = min(self.sizes, key=lambda name: self.sizes[name][0])
+        thumb_path = self.thumb_dir / f"{img_path.stem}_{size_name}.jpg"
+        if thumb_path.exists():
+            with Image.open(thumb_path) as thumb:
+                blur_hash, color = self.placeholders(thumb)
+            return {'blur_hash': blur_hash, 'color': color}
+    
+    def refresh_dhash(self, img_path, entry):
+        # Also from the smallest thumbnail, as in generate_thumbnails()
+        size_name = min(self.sizes, key=lambda name: self.sizes[name][0])
+        thumb_path = self.thumb_dir / f"{img_path.stem}_{size_name}.jpg"
+        if thumb_path.exists():
+            with Image.open(thumb_path) as thumb:
+                return {'dhash': self.dhash(thumb)}
+    
+    def run_batches(self, image_files):
+        """Process images in sorted order, batch_size at a time; returns how many were processed."""
+        executor = None
+        if self.jobs > 1:
+            print(f"   ⚙️  Hashing, EXIF and thumbnails on {self.jobs} worker processes")
+            executor = ProcessPoolExecutor(
+                max_workers=self.jobs,
+                initializer=init_worker,
+                initargs=(self.worker_settings(), str(self.thumb_dir)),
+            )
+        
+        try:
+            # Work out which images are new or changed
+            pending = self.find_pending(image_files, executor)
+            
+            # Analyse batch_size images together; workers prepare the next
+            # images meanwhile
+            processed = 0
+            batch = []
+            for item in self.prepared_images(pending, executor):
+                batch.append(item)
+                if len(batch) == self.batch_size:
+                    processed += self.process_batch(batch)
+                    batch = []
+            if batch:
+                processed += self.process_batch(batch)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        
+        return processed
+    
+    def run_pipeline(self, image_files):
+        """Process images through a staged pipeline; returns how many were processed.
+        
+        reader/hasher -> decoders -> inference (this thread) -> thumbnail
+        encoders -> recorder. While Moondream2 works on one batch, the next
+        images are being decoded and the previous ones encoded. Every queue
+        is bounded, so a slow stage holds the earlier ones back instead of
+        letting decoded originals pile up in memory.
+        """
+        to_decode = queue.Queue(PIPELINE_QUEUE_SIZE)
+        to_analyse = queue.Queue(PIPELINE_QUEUE_SIZE)
+        to_encode = queue.Queue(PIPELINE_QUEUE_SIZE)
+        to_record = queue.Queue(PIPELINE_QUEUE_SIZE)
+        errors = []
+        
+        def read():
+            seq = 0
+            try:
+                for img_path in sorted(image_files):
+                    file_hash = self.needs_processing(img_path)
+                    if file_hash is not None:
+                        to_decode.put({'seq': seq, 'path': img_path, 'hash': file_hash})
+                        seq += 1
+            except Exception as e:
+                errors.append(('read', e))
+            to_decode.put(PIPELINE_DONE)
+        
+        def decode(item):
+            exif_data, img, original_size = self.open_image(item['path'])
+            item.update(exif=exif_data, image=img, original_size=original_size,
+                        analysis_image=self.analysis_image(item['path'], img, original_size))
+            # Thumbnails come after inference here, so the near-duplicate
+            # check uses the analysis image; encode() stores the thumbnail's
+            item['dhash'] = self.dhash(item['analysis_image'])
+            return item
+        
+        def encode(item):
+            img = item.pop('image')
+            item.update(self.generate_thumbnails(
+                item['path'], img, item['original_size'],
+                self.previous_encodings(item['path'], item['hash'])
+            ))
+            if img.size == tuple(item['original_size']):
+                self.write_renditions(item['path'], item['hash'], img)
+            return item
+        
+        processed = 0
+        
+        def record():
+            # Entries are written in the reader's order, whatever order the
+            # encoders finish in, so gallery_metadata.json is deterministic
+            nonlocal processed
+            waiting = {}
+            next_seq = 0
+            while True:
+                item = to_record.get()
+                if item is PIPELINE_DONE:
+                    break
+                waiting[item['seq']] = item
+                while next_seq in waiting:
+                    item = waiting.pop(next_seq)
+                    next_seq += 1
+                    if errors:
+                        continue
+                    try:
+                        print(f"\n📷 {item['path'].name}")
+                        self.record_image(item['path'], item['hash'], item['ai_analysis'], item)
+                        processed += 1
+                    except Exception as e:
+                        errors.append(('record', e))
+        
+        threads = [threading.Thread(target=read, daemon=True)]
+        threads += self.pipeline_stage('decode', decode, to_decode, to_analyse, self.jobs, errors)
+        threads += self.pipeline_stage('encode', encode, to_encode, to_record, self.jobs, errors)
+        threads.append(threading.Thread(target=record, daemon=True))
+        for thread in threads:
+            thread.start()
+        
+        # Inference is the single consumer, batching whatever is decoded.
+        # Decoders finish out of order; batches follow the reader's order,
+        # as record() does, so the first of a set of near-duplicates is
+        # always the one analysed
+        waiting = {}
+        ready = deque()
+        next_seq = 0
+        done = False
+        while not done or ready:
+            while not done and len(ready) < self.batch_size:
+                item = to_analyse.get()
+                if item is PIPELINE_DONE:
+                    done = True
+                    break
+                waiting[item['seq']] = item
+                while next_seq in waiting:
+                    ready.append(waiting.pop(next_seq))
+                    next_seq += 1
+            batch = [ready.popleft() for _ in range(min(self.batch_size, len(ready)))]
+            
+            if batch and not errors:
+                # Earlier photos may still be queued for encoding, unrecorded;
+                # duplicate_source() checks those and this batch too
+                for item in batch:
+                    item['duplicate_of'] = self.duplicate_source(item['path'], item['dhash'])
+                todo = [item for item in batch if item['duplicate_of'] is None]
+                try:
+                    analyses = self.understand_images(
+                        [item['path'] for item in todo], [item['analysis_image'] for item in todo]
+                    ) if todo else []
+                except Exception as e:
+                    errors.append(('analyse', e))
+                    analyses = [None] * len(todo)
+                for item, ai_analysis in zip(todo, analyses):
+                    item['ai_analysis'] = ai_analysis
+                    self.remember_analysis(item['path'], ai_analysis)
+                for item in batch:
+                    if item['duplicate_of'] is not None:
+                        item['ai_analysis'] = self.duplicate_analysis(item['duplicate_of'])
+                        self.remember_analysis(item['path'], item['ai_analysis'])
+                    del item['analysis_image']
+            
+            for item in batch:
+                to_encode.put(item)
+        to_encode.put(PIPELINE_DONE)
+        
+        for thread in threads:
+            thread.join()
+        
+        if errors:
+            stage, error = errors[0]
+            raise RuntimeError(f"pipeline {stage} stage failed: {error}") from error
+        return processed
+    
+    def pipeline_stage(self, name, func, inbox, outbox, workers, errors):
+        """Start threads that apply func to each inbox item and pass results on.
+        
+        After an error the threads keep draining their inbox so upstream
+        stages never block on a full queue; the last thread to see the end
+        marker forwards it downstream.
+        """
+        remaining = [workers]
+        lock = threading.Lock()
+        
+        def work():
+            while True:
+                item = inbox.get()
+                if item is PIPELINE_DONE:
+                    # Let sibling threads see the end marker too
+                    inbox.put(PIPELINE_DONE)
+                    with lock:
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    if last:
+                        outbox.put(PIPELINE_DONE)
+                    return
+                if errors:
+                    continue
+                try:
+                    outbox.put(func(item))
+                except Exception as e:
+                    errors.append((name, e))
+        
+        return [threading.Thread(target=work, daemon=True) for _ in range(workers)]
     
     def update_gallery_page(self):
-        """Update the photography.md page with all photos from metadata."""
+        """Update the photography.md page with all photos from metadata.
+        
+        Incremental: rendered cards are cached by a fingerprint of their
+        inputs, and a page is not rewritten unless its bytes change. With
+        --gallery-split the cards are spread over several pages (shards),
+        each with a small JSON manifest, and only changed shards are written.
+        """
         print("\n📝 Updating gallery page with all photos...")
         
-        page_path = Path("content/pages/photography.md")
+        page_path = self.gallery_page
         if not page_path.exists():
             print("  ❌ Photography page not found!")
             return
@@ -466,20 +2450,355 @@ class SmartPhotoManager:
         with open(page_path, 'r') as f:
             content = f.read()
         
+        # Card inputs in gallery order and per-category counts, in one pass
+        ordered = []
+        manifest_photos = []
+        category_counts = Counter()
+        for filename, data in self.gallery_order():
+            fields = self.card_fields(filename, data)
+            ordered.append((filename, fields))
+            manifest_photos.append(self.manifest_entry(filename, data, fields))
+            category_counts[fields['category']] += 1
+        categories = sorted(category_counts)
+        
+        render_cache = self.load_render_cache()
+        cached_cards = render_cache.get('cards', {})
+        cached_pages = render_cache.get('pages', {})
+        cards = {}
+        pages = {}
+        
+        shards = self.gallery_shards(ordered, category_counts)
+        pager = []
+        if len(shards) > 1:
+            pager = [(shard['slug'], shard['label'], len(shard['items'])) for shard in shards]
+        
+        written = 0
+        rendered = 0
+        for shard in shards:
+            if shard['slug'] == GALLERY_SLUG:
+                shard_path, base = page_path, content
+            else:
+                shard_path = page_path.with_name(f"{shard['slug']}.md")
+                base = self.shard_header(content, shard['title'], shard['slug'])
+            
+            result = self.render_gallery_page(
+                shard_path, base, shard, pager, cached_cards, cached_pages.get(shard['slug'], {}), cards
+            )
+            if result is None:
+                return
+            changed, shard_rendered, pages[shard['slug']] = result
+            written += changed
+            rendered += shard_rendered
+        
+        self.update_shard_manifests(shards)
+        self.update_manifest(manifest_photos)
+        # Rewritten only when a card or page changed
+        if {'cards': cards, 'pages': pages} != render_cache:
+            self.save_render_cache({'cards': cards, 'pages': pages})
+        
+        if written:
+            print(f"  ✅ Gallery updated with {len(self.metadata)} photos "
+                  f"({rendered} card(s) re-rendered, {written} of {len(shards)} page(s) written)")
+        else:
+            print(f"  ✅ Gallery already up to date ({len(self.metadata)} photos, {len(shards)} page(s))")
+        print(f"  📊 Categories: {', '.join(categories)}")
+    
+    def render_gallery_page(self, page_path, base, shard, pager, cached_cards, cached_page, cards):
+        """Splice one shard's cards and filters into base and write page_path if it changed.
+        
+        Returns (changed, cards rendered, render cache entry for the page),
+        or None if base has no gallery markers.
+        """
         # Find the gallery section
         start_marker = '<div class="photo-masonry" id="photoGallery">'
         end_marker = '</div>\n\n<!-- Lightbox Modal -->'
         
-        start_idx = content.find(start_marker)
-        end_idx = content.find(end_marker)
+        start_idx = base.find(start_marker)
+        end_idx = base.find(end_marker)
         
         if start_idx == -1 or end_idx == -1:
             print("  ⚠️  Could not find gallery markers in page")
+            return None
+        
+        # Find the filter buttons, which sit before the gallery
+        filter_start = '<div class="photo-filters">'
+        filter_end = '</div>\n\n<div class="photo-masonry"'
+        
+        filter_start_idx = base.find(filter_start, 0, start_idx)
+        filter_end_idx = base.find(filter_end, 0, start_idx + len(filter_end))
+        has_filters = filter_start_idx != -1 and filter_end_idx != -1
+        
+        # Nothing that feeds the page changed since it was last written
+        items = shard['items']
+        counts = shard['counts']
+        if has_filters:
+            outside = base[:filter_start_idx] + base[filter_end_idx:start_idx] + base[end_idx:]
+        else:
+            outside = base[:start_idx] + base[end_idx:]
+        page_fingerprint = self.fingerprint([
+            shard['slug'], items, sorted(counts.items()), pager,
+            hashlib.md5(outside.encode('utf-8')).hexdigest(),
+        ])
+        page_hash = None
+        if page_path.exists():
+            page_hash = hashlib.md5(page_path.read_text().encode('utf-8')).hexdigest()
+        if (page_hash is not None
+                and cached_page.get('fingerprint') == page_fingerprint
+                and cached_page.get('page_hash') == page_hash):
+            for filename, _ in items:
+                if filename in cached_cards:
+                    cards[filename] = cached_cards[filename]
+            return False, 0, cached_page
+        
+        # Photo cards for this page, reusing cached cards whose inputs
+        # haven't changed; rendered lazily as the page is streamed out
+        rendered = 0
+        
+        def photo_cards():
+            nonlocal rendered
+            yield start_marker
+            for filename, fields in items:
+                card_fingerprint = self.fingerprint(fields)
+                cached = cached_cards.get(filename)
+                if cached and cached['fingerprint'] == card_fingerprint:
+                    card = cached['html']
+                else:
+                    card = self.render_card(fields)
+                    rendered += 1
+                cards[filename] = {'fingerprint': card_fingerprint, 'html': card}
+                yield '\n' + card
+            yield '\n</div>'
+            if pager:
+                yield '\n' + self.render_pager(pager, shard['slug'])
+        
+        def page_segments():
+            gallery_from = 0
+            
+            # Update filter buttons with categories
+            if has_filters:
+                filters = [filter_start]
+                filters.append('    <button class="filter-btn active" data-filter="all">All</button>')
+                for cat in sorted(counts):
+                    filters.append(
+                        f'    <button class="filter-btn" data-filter="{cat}">{cat.title()} ({counts[cat]})</button>'
+                    )
+                filters.append('</div>\n')
+                
+                yield base[:filter_start_idx]
+                yield '\n'.join(filters)
+                gallery_from = filter_end_idx
+            
+            # Replace gallery content
+            yield base[gallery_from:start_idx]
+            yield from photo_cards()
+            yield base[end_idx:]
+        
+        # Write updated page, but only if it actually changed, so static-site
+        # build caches aren't invalidated for nothing
+        changed, new_page_hash = self.write_page(page_path, page_segments(), page_hash)
+        return changed, rendered, {'fingerprint': page_fingerprint, 'page_hash': new_page_hash}
+    
+    def gallery_shards(self, ordered, category_counts):
+        """Split the ordered cards into the pages --gallery-split asks for.
+        
+        The first shard is always photography.md itself.
+        """
+        if self.gallery_split == 'single':
+            return [{'slug': GALLERY_SLUG, 'title': None, 'label': 'All',
+                     'items': ordered, 'counts': category_counts}]
+        
+        shards = []
+        
+        def add_shard(slug, title, label, items):
+            counts = Counter(fields['category'] for _, fields in items)
+            shards.append({'slug': slug, 'title': title, 'label': label, 'items': items, 'counts': counts})
+        
+        def add_pages(slug, title, label, items):
+            for number, start in enumerate(range(0, max(len(items), 1), self.page_size), 1):
+                if number == 1:
+                    add_shard(slug, title, label, items[:self.page_size])
+                else:
+                    add_shard(f"{slug}-page-{number}", f"{title or 'Photography'} (page {number})",
+                              f"{label} {number}", items[start:start + self.page_size])
+        
+        if self.gallery_split == 'pages':
+            add_pages(GALLERY_SLUG, None, 'Page', ordered)
+            shards[0]['label'] = 'Page 1'
+        else:
+            # The main page shows the first photos overall, then one set of
+            # pages per category
+            add_shard(GALLERY_SLUG, None, 'Latest', ordered[:self.page_size])
+            by_category = defaultdict(list)
+            for filename, fields in ordered:
+                by_category[fields['category']].append((filename, fields))
+            for category in sorted(by_category):
+                add_pages(f"{GALLERY_SLUG}-{category}", f"Photography: {category.title()}",
+                          category.title(), by_category[category])
+        
+        return shards
+    
+    def shard_header(self, content, title, slug):
+        """The main page with its Pelican Title/Slug header rewritten for a shard.
+        
+        Shards are also marked Gallery_shard, which the Astro migration skips:
+        its photography route renders the whole gallery from the metadata.
+        """
+        header, sep, body = content.partition('\n\n')
+        lines = []
+        for line in header.splitlines():
+            if line.startswith('Title:'):
+                line = f"Title: {title}"
+            elif line.startswith('Slug:'):
+                line = f"Slug: {slug}"
+            lines.append(line)
+        lines.append(f"Gallery_shard: {GALLERY_SLUG}")
+        return '\n'.join(lines) + sep + body
+    
+    def page_url(self, slug):
+        # Matches the legacy URLs the Astro migration gives content/pages/*.md
+        return f"/pages/{slug}.html"
+    
+    def render_pager(self, pager, current_slug):
+        """Links between gallery shards, with the current one highlighted."""
+        link_template = PageTemplate.load('gallery_pager_link.html')
+        links = []
+        for slug, label, count in pager:
+            links.append(link_template.render({
+                'classes': 'filter-btn active' if slug == current_slug else 'filter-btn',
+                'url': self.page_url(slug),
+                'label': label,
+                'count': count,
+            }))
+        return PageTemplate.load('gallery_pager.html').render({'links': '\n'.join(links)})
+    
+    def update_shard_manifests(self, shards):
+        """Write a JSON manifest per gallery shard and remove shards that no longer exist.
+        
+        Manifests and pages are only rewritten when their contents change.
+        """
+        index_path = self.shard_dir / "index.json"
+        previous = {}
+        if index_path.exists():
+            with open(index_path, 'r') as f:
+                previous = {shard['slug']: shard for shard in json.load(f).get('shards', [])}
+        
+        current = {} if self.gallery_split == 'single' else {shard['slug'] for shard in shards}
+        
+        # Pages and manifests from an earlier split that are no longer produced
+        for slug in set(previous) - set(current):
+            if slug != GALLERY_SLUG:
+                self.gallery_page.with_name(f"{slug}.md").unlink(missing_ok=True)
+            (self.shard_dir / f"{slug}.json").unlink(missing_ok=True)
+        
+        if not current:
+            if index_path.exists():
+                index_path.unlink()
+                if not any(self.shard_dir.iterdir()):
+                    self.shard_dir.rmdir()
             return
         
-        # Generate photo cards for all images
-        photo_cards = [start_marker]
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        index = {'split': self.gallery_split, 'page_size': self.page_size, 'shards': []}
+        for number, shard in enumerate(shards, 1):
+            manifest = {
+                'slug': shard['slug'],
+                'title': shard['title'] or 'Photography',
+                'url': self.page_url(shard['slug']),
+                'page': number,
+                'pages': len(shards),
+                'count': len(shard['items']),
+                'categories': dict(sorted(shard['counts'].items())),
+                'photos': [filename for filename, _ in shard['items']],
+            }
+            self.write_if_changed(self.shard_dir / f"{shard['slug']}.json", json.dumps(manifest, indent=2) + '\n')
+            index['shards'].append({
+                'slug': shard['slug'],
+                'url': manifest['url'],
+                'count': manifest['count'],
+                'manifest': f"{shard['slug']}.json",
+            })
+        self.write_if_changed(index_path, json.dumps(index, indent=2) + '\n')
+    
+    def manifest_entry(self, filename, data, fields):
+        """One photo in gallery_manifest.json, with short keys and no AI analysis."""
+        entry = {'id': filename, 't': fields['title'], 'c': fields['category']}
+        original_size = data.get('original_size')
+        if original_size:
+            entry['w'], entry['h'] = original_size
         
+        # Thumbnails as [file, width, height], in the order of the manifest's 's' list
+        thumbnail_sizes = data.get('thumbnail_sizes', {})
+        entry['th'] = [
+            [f"{fields['stem']}_{size_name}.jpg", *thumbnail_sizes.get(size_name, [])]
+            for size_name in self.sizes
+        ]
+        if data.get('blur_hash'):
+            entry['bh'] = data['blur_hash']
+        if data.get('color'):
+            entry['col'] = data['color']
+        
+        # srcset renditions as [width, file], files relative to the thumbnails
+        renditions = data.get('srcset')
+        if renditions:
+            entry['r'] = [[int(width), f"srcset/{name}"] for width, name in
+                          sorted(renditions.items(), key=lambda item: int(item[0]))]
+        
+        # WebP/AVIF copies that sit next to the JPEG thumbnails
+        formats = [fmt for fmt in data.get('encodings') or {} if fmt != 'target']
+        if formats:
+            entry['f'] = formats
+        return entry
+    
+    def update_manifest(self, photos):
+        """Write the minified gallery manifest, plus any pre-compressed variants.
+        
+        Nothing is rewritten unless the manifest changed.
+        """
+        manifest = {
+            'v': MANIFEST_VERSION,
+            # Thumbnail files are relative to this URL
+            'b': '/images/photography/thumbnails/',
+            's': list(self.sizes),
+            'p': photos,
+        }
+        text = json.dumps(manifest, separators=(',', ':'), ensure_ascii=False)
+        changed = self.write_if_changed(self.manifest_file, text)
+        
+        data = text.encode('utf-8')
+        for compression in MANIFEST_COMPRESSION:
+            if compression == 'gzip':
+                path = self.manifest_file.with_name(self.manifest_file.name + '.gz')
+            else:
+                path = self.manifest_file.with_name(self.manifest_file.name + '.br')
+            
+            if compression not in self.manifest_compress:
+                path.unlink(missing_ok=True)
+                continue
+            if path.exists() and not changed:
+                continue
+            
+            if compression == 'gzip':
+                import gzip
+                # mtime=0 keeps the bytes stable for unchanged manifests
+                compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            else:
+                import brotli
+                compressed = brotli.compress(data, quality=11)
+            tmp_path = path.with_name(path.name + '.tmp')
+            tmp_path.write_bytes(compressed)
+            os.replace(tmp_path, path)
+        
+        if changed:
+            print(f"  🗂️  Manifest: {len(photos)} photos, {len(data) / 1024:.1f} KB")
+    
+    def write_if_changed(self, path, text):
+        if path.exists() and path.read_text() == text:
+            return False
+        write_atomic(path, text)
+        return True
+    
+    def gallery_order(self):
+        """Metadata items in gallery order."""
         # Sort photos by: 1) manual order, 2) date taken, 3) filename
         def sort_key(item):
             filename, data = item
@@ -490,73 +2809,133 @@ class SmartPhotoManager:
             # Priority 3: Filename for consistent ordering
             return (manual_order, date_taken if date_taken else 'z' + filename, filename)
         
-        for filename, data in sorted(self.metadata.items(), key=sort_key):
-            stem = Path(filename).stem
-            title = data.get('title', 'Photo')
-            # Use the longest description from the descriptions array, or fall back to caption
-            ai_analysis = data.get('ai_analysis', {})
-            descriptions = ai_analysis.get('descriptions', [])
-            if descriptions:
-                # Use the longest description for better quality
-                description = max(descriptions, key=len) if descriptions else ai_analysis.get('caption', '')
-            else:
-                description = data.get('description', ai_analysis.get('caption', ''))
-            category = data.get('category', 'general')
-            
-            # Check if GPS location is available
-            location_html = ""
-            if data.get('exif', {}).get('gps', {}).get('coordinates'):
-                gps_data = data['exif']['gps']
-                location_display = gps_data.get('location', gps_data['coordinates'])
-                location_html = f'''        <div class="photo-location">
-            <svg width="12" height="12" viewBox="0 0 24 24" fill="currentColor">
-                <path d="M12 2C8.13 2 5 5.13 5 9c0 5.25 7 13 7 13s7-7.75 7-13c0-3.87-3.13-7-7-7zm0 9.5c-1.38 0-2.5-1.12-2.5-2.5s1.12-2.5 2.5-2.5 2.5 1.12 2.5 2.5-1.12 2.5-2.5 2.5z"/>
-            </svg>
-            <span>{location_display}</span>
-        </div>
-'''
-            
-            card = f'''    <div class="photo-card" data-category="{category}" data-full="/images/photography/{filename}">
-{location_html}        <img src="/images/photography/thumbnails/{stem}_small.jpg" 
-             data-medium="/images/photography/thumbnails/{stem}_large.jpg"
-             alt="{title}" loading="lazy">
-        <div class="photo-overlay">
-            <h3>{title}</h3>
-            <p>{description}</p>
-        </div>
-    </div>'''
-            photo_cards.append(card)
-        
-        photo_cards.append('</div>')
-        
-        # Replace gallery content
-        new_content = content[:start_idx] + '\n'.join(photo_cards) + content[end_idx:]
-        
-        # Update filter buttons with categories
-        categories = sorted(set(d.get('category', 'general') for d in self.metadata.values()))
+        return sorted(self.metadata.items(), key=sort_key)
+    
+    def card_fields(self, filename, data):
+        """Everything a gallery card is rendered from."""
+        title = data.get('title', 'Photo')
+        # Use the longest description from the descriptions array, or fall back to caption
+        ai_analysis = data.get('ai_analysis', {})
+        descriptions = ai_analysis.get('descriptions', [])
+        if descriptions:
+            # Use the longest description for better quality
+            description = max(descriptions, key=len) if descriptions else ai_analysis.get('caption', '')
+        else:
+            description = data.get('description', ai_analysis.get('caption', ''))
         
-        filter_start = '<div class="photo-filters">'
-        filter_end = '</div>\n\n<div class="photo-masonry"'
+        # Check if GPS location is available
+        location = None
+        if data.get('exif', {}).get('gps', {}).get('coordinates'):
+            gps_data = data['exif']['gps']
+            location = gps_data.get('location', gps_data['coordinates'])
         
-        filter_start_idx = new_content.find(filter_start)
-        filter_end_idx = new_content.find(filter_end)
+        # Responsive renditions from update_renditions(), if this photo has any
+        srcset = ""
+        renditions = data.get('srcset')
+        if renditions:
+            candidates = ', '.join(
+                f"/images/photography/thumbnails/srcset/{quote(name)} {width}w"
+                for width, name in sorted(renditions.items(), key=lambda item: int(item[0]))
+            )
+            srcset = f'srcset="{candidates}" sizes="{SRCSET_SIZES}"'
         
-        if filter_start_idx != -1 and filter_end_idx != -1:
-            filters = [filter_start]
-            filters.append('    <button class="filter-btn active" data-filter="all">All</button>')
-            for cat in categories:
-                count = sum(1 for d in self.metadata.values() if d.get('category') == cat)
-                filters.append(f'    <button class="filter-btn" data-filter="{cat}">{cat.title()} ({count})</button>')
-            filters.append('</div>\n')
-            
-            new_content = new_content[:filter_start_idx] + '\n'.join(filters) + new_content[filter_end_idx:]
+        # WebP/AVIF copies of the thumbnails, offered ahead of the JPEGs
+        sources = []
+        stem = Path(filename).stem
+        thumbnail_sizes = data.get('thumbnail_sizes') or {}
+        for fmt, qualities in (data.get('encodings') or {}).items():
+            if fmt == 'target':
+                continue
+            # One file per width: small originals give every size the same one
+            by_width = {}
+            for size_name in qualities:
+                if size_name in thumbnail_sizes:
+                    by_width.setdefault(thumbnail_sizes[size_name][0], f"{stem}_{size_name}.{fmt}")
+            candidates = ', '.join(
+                f"/images/photography/thumbnails/{quote(name)} {width}w" for width, name in sorted(by_width.items())
+            )
+            if candidates:
+                sources.append([fmt, candidates])
         
-        # Write updated page
-        with open(page_path, 'w') as f:
-            f.write(new_content)
+        # Placeholder painted while the thumbnail loads
+        placeholder = ""
+        if data.get('blur_hash') and data.get('color'):
+            placeholder = (f' data-blurhash="{escape(data["blur_hash"])}" data-color="{data["color"]}"'
+                           f' style="background-color: {data["color"]}"')
         
-        print(f"  ✅ Gallery updated with {len(self.metadata)} photos")
-        print(f"  📊 Categories: {', '.join(categories)}")
+        return {
+            'filename': filename,
+            'stem': stem,
+            'placeholder': placeholder,
+            'srcset': srcset,
+            'sources': sources,
+            'title': title,
+            'description': description,
+            'category': data.get('category', 'general'),
+            'location': location,
+            # Cached cards are re-rendered whenever a template file changes
+            'template': self.card_templates_digest(),
+        }
+    
+    def card_templates_digest(self):
+        if self.templates_digest is None:
+            self.templates_digest = (PageTemplate.load('gallery_card.html').digest
+                                     + PageTemplate.load('gallery_card_location.html').digest
+                                     + PageTemplate.load('gallery_card_source.html').digest)
+        return self.templates_digest
+    
+    def render_card(self, fields):
+        """Render one photo card from card_fields() with the card templates."""
+        location_html = ""
+        if fields['location']:
+            location_html = PageTemplate.load('gallery_card_location.html').render(fields) + '\n'
+        
+        # With WebP/AVIF copies the <img> becomes a <picture> fallback
+        picture = picture_end = ""
+        if fields['sources']:
+            source_template = PageTemplate.load('gallery_card_source.html')
+            picture = '        <picture>\n' + ''.join(
+                source_template.render({'format': fmt, 'srcset': candidates, 'sizes': SRCSET_SIZES}) + '\n'
+                for fmt, candidates in fields['sources']
+            )
+            picture_end = '\n        </picture>'
+        
+        return PageTemplate.load('gallery_card.html').render(
+            dict(fields, location=location_html, picture=picture, picture_end=picture_end)
+        )
+    
+    def write_page(self, page_path, segments, old_hash):
+        """Stream segments to page_path through a temp file.
+        
+        The page is only replaced if the streamed bytes differ from old_hash.
+        Returns (changed, new_hash).
+        """
+        tmp_path = page_path.with_name(page_path.name + '.tmp')
+        digest = hashlib.md5()
+        with open(tmp_path, 'w') as f:
+            for segment in segments:
+                f.write(segment)
+                digest.update(segment.encode('utf-8'))
+        
+        new_hash = digest.hexdigest()
+        if new_hash == old_hash:
+            tmp_path.unlink()
+            return False, new_hash
+        os.replace(tmp_path, page_path)
+        return True, new_hash
+    
+    def fingerprint(self, value):
+        return hashlib.md5(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def load_render_cache(self):
+        try:
+            with open(self.render_cache_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def save_render_cache(self, render_cache):
+        write_atomic(self.render_cache_file, json.dumps(render_cache))
     
     def run(self):
         """Main workflow."""
@@ -579,32 +2958,198 @@ class SmartPhotoManager:
         image_files = [f for f in image_files if 'thumbnails' not in str(f)]
         
         print(f"\n📁 Found {len(image_files)} images")
-        if self.ai_available:
-            print("   ✨ Using Moondream2 for intelligent image understanding")
-            print("   🚀 Faster and more creative than larger models!")
+        if self.unsupported_formats:
+            print(f"   ⚠️  This Pillow can't write {', '.join(self.unsupported_formats)}; skipping")
+        print("   ✨ Moondream2 loads on demand, only if an image needs analysis")
+        
+        self.reconcile(image_files)
+        if self.dry_run:
+            print("\n🔎 Dry run - nothing was changed")
+            return
+        
+        if self.refresh:
+            # Metadata-only: derived fields are recomputed, nothing is analysed
+            processed = 0
+        elif self.pipeline:
+            print(f"   🔀 Pipelined: {self.jobs} decoder and {self.jobs} encoder thread(s)")
+            processed = self.run_pipeline(image_files)
         else:
-            print("   ⚠️  AI not available, using basic analysis")
+            processed = self.run_batches(image_files)
+        if not self.refresh:
+            self.update_thumbnails(image_files)
         
-        # Process images
-        processed = 0
-        for img_path in sorted(image_files):
-            if self.process_image(img_path):
-                processed += 1
+        # Before the refresh, so the prototypes stage sees the new embeddings
+        if self.embed:
+            self.embed_missing()
+        if self.refresh:
+            self.run_refresh()
+        self.embeddings.save(self.metadata)
+        
+        self.update_renditions()
         
         # Save metadata
-        with open(self.metadata_file, 'w') as f:
-            json.dump(self.metadata, f, indent=2)
+        self.save_metadata()
         
         # Update gallery page with all photos
         self.update_gallery_page()
         
         print("\n" + "=" * 60)
         print(f"✅ COMPLETE - Processed {processed} new/updated images")
+        if processed == 0:
+            print("⚡ Everything up to date" + ("" if self.model_loaded else " - Moondream2 was never loaded"))
+        elif not self.model_loaded:
+            print("⚡ Moondream2 was never loaded - every analysis came from the answer cache or a near-duplicate")
         print(f"📊 Total images in gallery: {len(self.metadata)}")
         print("\n💡 Gallery page has been updated!")
         print("   Just rebuild to see your photos!")
         print("=" * 60)
 
 if __name__ == "__main__":
-    manager = SmartPhotoManager()
-    manager.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Smart photo manager using Moondream2.")
+    parser.add_argument(
+        '--batch-size', type=int, default=1,
+        help="analyse this many new photos together in one batched Moondream2 pass (default: 1)"
+    )
+    parser.add_argument(
+        '--analysis-mode', choices=['questions', 'structured'], default='questions',
+        help="ask five separate questions per photo, or one structured prompt parsed into the same fields"
+    )
+    parser.add_argument(
+        '--hash', choices=HASH_ALGORITHMS, default='md5', dest='hash_algorithm',
+        help="hash used to detect changed originals (xxh64 needs the xxhash package)"
+    )
+    parser.add_argument(
+        '--thumbnails', choices=['direct', 'cascade'], default='direct', dest='thumbnail_mode',
+        help="resample every size from the original, or each size from the next larger one"
+    )
+    parser.add_argument(
+        '--jpeg-draft', action='store_true',
+        help="decode JPEG originals at the smallest libjpeg scale that covers the largest thumbnail"
+    )
+    parser.add_argument(
+        '--cascade-check', action='store_true',
+        help=f"compare cascaded thumbnails against direct ones and fall back below {CASCADE_MIN_PSNR:.0f} dB PSNR"
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help="worker processes for hashing, EXIF and thumbnails; inference stays in this process (default: 1)"
+    )
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help="overlap hashing, decoding, inference and thumbnail encoding across images using threads "
+             "(--jobs sets the decoder and encoder thread counts)"
+    )
+    parser.add_argument(
+        '--checkpoint-every', type=int, default=CHECKPOINT_EVERY,
+        help=f"rewrite gallery_metadata.json after this many new images (default: {CHECKPOINT_EVERY})"
+    )
+    parser.add_argument(
+        '--checkpoint-seconds', type=float, default=CHECKPOINT_SECONDS,
+        help=f"or after this many seconds since the last checkpoint (default: {CHECKPOINT_SECONDS})"
+    )
+    parser.add_argument(
+        '--store', choices=sorted(STORES),
+        help="metadata backend: 'json' (one gallery_metadata.json) or 'sharded' (one file per photo "
+             "under metadata/, exported to gallery_metadata.json); default: whichever is in use"
+    )
+    parser.add_argument(
+        '--gallery-split', choices=['single', 'pages', 'category'], default='single',
+        help="put every card on photography.md, split them into pages of --page-size, "
+             "or add pages per category; each extra page gets a JSON manifest in gallery_shards/"
+    )
+    parser.add_argument(
+        '--page-size', type=int, default=GALLERY_PAGE_SIZE,
+        help=f"photos per gallery page with --gallery-split (default: {GALLERY_PAGE_SIZE})"
+    )
+    parser.add_argument(
+        '--manifest-compress', choices=MANIFEST_COMPRESSION, action='append', default=[],
+        help="also write a pre-compressed gallery_manifest.json.gz / .br "
+             "(repeatable; brotli needs the brotli package)"
+    )
+    parser.add_argument(
+        '--format', choices=sorted(FORMAT_QUALITY), action='append', default=[], dest='formats',
+        help="also write every thumbnail in this format (repeatable; avif needs a Pillow built with it)"
+    )
+    quality_search = parser.add_mutually_exclusive_group()
+    quality_search.add_argument(
+        '--target-ssim', type=float,
+        help="search for the lowest --format quality reaching this SSIM (e.g. 0.98)"
+    )
+    quality_search.add_argument(
+        '--target-bytes', type=int,
+        help="search for the highest --format quality that fits this many bytes per thumbnail"
+    )
+    parser.add_argument(
+        '--srcset-widths', nargs='?', const=','.join(map(str, SRCSET_WIDTHS)),
+        help="give every photo resized renditions at these comma-separated widths and list them "
+             f"in the card's srcset (default ladder: {','.join(map(str, SRCSET_WIDTHS))})"
+    )
+    parser.add_argument(
+        '--prune', action='store_true',
+        help="remove metadata entries whose original is gone and thumbnails no entry owns"
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="only report the renames and orphans reconciliation finds, then stop"
+    )
+    parser.add_argument(
+        '--refresh', type=lambda value: value.split(','), default=[],
+        help="only recompute these comma-separated fields for every photo, plus the fields "
+             f"derived from them, from metadata and EXIF headers ({', '.join(REFRESH_GRAPH)})"
+    )
+    parser.add_argument(
+        '--embed', action='store_true',
+        help="encode photos without an embedding yet (vision encoder only, no generation)"
+    )
+    parser.add_argument(
+        '--similar', metavar='FILENAME',
+        help="list the photos whose embeddings are closest to this one, then stop"
+    )
+    parser.add_argument(
+        '--top', type=int, default=8,
+        help="how many photos --similar lists (default: 8)"
+    )
+    parser.add_argument(
+        '--reuse-duplicates', action='store_true',
+        help="copy the analysis of a near-duplicate photo instead of running inference"
+    )
+    parser.add_argument(
+        '--duplicates', action='store_true',
+        help="list groups of near-duplicate photos, then stop"
+    )
+    args = parser.parse_args()
+    unknown = [stage for stage in args.refresh if stage not in REFRESH_GRAPH]
+    if unknown:
+        parser.error(f"--refresh: unknown field(s) {', '.join(unknown)}; choose from {', '.join(REFRESH_GRAPH)}")
+    
+    manager = SmartPhotoManager(
+        reuse_duplicates=args.reuse_duplicates,
+        embed=args.embed,
+        refresh=args.refresh,
+        prune=args.prune,
+        dry_run=args.dry_run,
+        srcset_widths=[int(width) for width in args.srcset_widths.split(',')] if args.srcset_widths else None,
+        formats=args.formats,
+        target_ssim=args.target_ssim,
+        target_bytes=args.target_bytes,
+        manifest_compress=args.manifest_compress,
+        gallery_split=args.gallery_split,
+        page_size=args.page_size,
+        store=args.store,
+        jobs=args.jobs,
+        pipeline=args.pipeline,
+        checkpoint_every=args.checkpoint_every,
+        checkpoint_seconds=args.checkpoint_seconds,
+        batch_size=args.batch_size,
+        analysis_mode=args.analysis_mode,
+        hash_algorithm=args.hash_algorithm,
+        thumbnail_mode=args.thumbnail_mode,
+        jpeg_draft=args.jpeg_draft,
+        cascade_check=args.cascade_check,
+    )
+    if args.similar:
+        manager.print_similar(args.similar, args.top)
+    elif args.duplicates:
+        manager.report_duplicates()
+    else:
+        manager.run()
\ No newline at end of file
@@ -6,18 +6,16 @@ Usage: python set_photo_order.py
 This allows you to manually control the order of photos in your gallery.
 """
 
-import json
-from pathlib import Path
+from gallery_store import open_store
 
 def set_photo_order():
-    metadata_file = Path("content/images/photography/gallery_metadata.json")
+    store = open_store()
     
-    if not metadata_file.exists():
+    if not store.metadata_file.exists():
         print("❌ Metadata file not found. Run 'uv run scripts/photo_manager.py' first.")
         return
     
-    with open(metadata_file) as f:
-        metadata = json.load(f)
+    metadata = store.load()
     
     print("\n📸 Current photos in gallery:")
     print("-" * 50)
@@ -75,9 +73,8 @@ def set_photo_order():
         except ValueError:
             print(f"❌ Invalid order number: {order_str}")
     
-    # Save metadata
-    with open(metadata_file, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    # Save metadata (only changed photos are rewritten with the sharded store)
+    store.save(metadata)
     
     print("\n✅ Photo order updated!")
     print("Run 'uv run scripts/photo_manager.py' to regenerate the gallery.")
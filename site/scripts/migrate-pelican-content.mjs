@@ -192,6 +192,11 @@ async function migratePages() {
   for (const file of files.sort()) {
     const source = await readFile(path.join(PAGE_SOURCE, file), 'utf8');
     const { metadata, body } = parsePelicanDocument(source);
+    if (metadata.gallery_shard) {
+      // Extra pages from photo_manager.py --gallery-split; the photography
+      // page renders the whole gallery from its metadata instead
+      continue;
+    }
     const slug = metadata.slug || metadata.title?.toLowerCase().replace(/\s+/g, '-') || file.replace(/\.md$/i, '');
     const title = metadata.title || slug.replace(/(^|-)\w/g, (match) => match.toUpperCase());
     const pageType = slug === 'about' ? 'about' : slug === 'projects' ? 'projects' : slug === 'photography' ? 'photography' : 'page';
@@ -42,8 +42,8 @@ function mapPhoto([filename, item], index) {
     hidden: false,
     order: index + 1,
     categories: item.category ? [item.category] : [],
-    color: null,
-    blurHash: null,
+    color: item.color || null,
+    blurHash: item.blur_hash || null,
     width: item.original_size?.[0] || 1600,
     height: item.original_size?.[1] || 1200,
     createdAt: date,
@@ -95,7 +95,12 @@ async function main() {
       recursive: true,
       force: true,
       filter(source) {
-        return !source.endsWith('.DS_Store');
+        return (
+          !source.endsWith('.DS_Store')
+          && !/(\.(sqlite(-wal|-shm)?|journal|tmp)|_render_cache\.json|embeddings\.(npy|json)|file_stats\.json)$/.test(source)
+          // Per-photo metadata shards; the site only needs gallery_metadata.json
+          && !source.startsWith(path.join(SOURCE_IMAGES, 'photography', 'metadata'))
+        );
       },
     });
     await cp(SOURCE_CNAME, tempCnamePath, { force: true });